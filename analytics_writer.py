@@ -0,0 +1,101 @@
+"""Background writer for `analytics` events.
+
+log() only queues the event. A daemon thread writes queued events with one
+executemany() per batch, once ANALYTICS_BATCH_SIZE events have built up or
+the oldest has waited ANALYTICS_FLUSH_INTERVAL seconds. Whatever is still
+queued is flushed when the worker exits.
+"""
+import os
+import queue
+import time
+
+from background_queue import BackgroundQueue, STOP
+
+ANALYTICS_QUEUE_SIZE = int(os.getenv('ANALYTICS_QUEUE_SIZE', 10000))
+ANALYTICS_BATCH_SIZE = int(os.getenv('ANALYTICS_BATCH_SIZE', 100))
+ANALYTICS_FLUSH_INTERVAL = float(os.getenv('ANALYTICS_FLUSH_INTERVAL', 2))
+# What log() does when the queue is full: 'drop' the event, or 'block' the
+# request for up to ANALYTICS_BLOCK_TIMEOUT seconds before dropping it
+ANALYTICS_QUEUE_POLICY = os.getenv('ANALYTICS_QUEUE_POLICY', 'drop')
+ANALYTICS_BLOCK_TIMEOUT = float(os.getenv('ANALYTICS_BLOCK_TIMEOUT', 1))
+
+INSERT_QUERY = "INSERT INTO analytics (user_id, event, metadata) VALUES (%s, %s, %s)"
+
+
+class AnalyticsWriter(object):
+
+    def __init__(self, connect, queue_size=ANALYTICS_QUEUE_SIZE, batch_size=ANALYTICS_BATCH_SIZE,
+                 flush_interval=ANALYTICS_FLUSH_INTERVAL, policy=ANALYTICS_QUEUE_POLICY,
+                 block_timeout=ANALYTICS_BLOCK_TIMEOUT):
+        if policy not in ('drop', 'block'):
+            raise ValueError(f"Unknown analytics queue policy: {policy}")
+        self.connect = connect  # Opens a connection owned by the writer thread
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.dropped = 0
+        self.written = 0
+        self._worker = BackgroundQueue(self._run, 'analytics-writer', queue_size)
+
+    def log(self, user_id, event, metadata=None):
+        q = self._worker.ensure_started()
+        try:
+            if self.policy == 'block':
+                q.put((user_id, event, metadata), timeout=self.block_timeout)
+            else:
+                q.put_nowait((user_id, event, metadata))
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self, q):
+        connection = None
+        stopping = False
+        while not stopping:
+            batch = []
+            item = q.get()
+            deadline = time.monotonic() + self.flush_interval
+            while item is not STOP:
+                batch.append(item)
+                timeout = deadline - time.monotonic()
+                if len(batch) >= self.batch_size or timeout <= 0:
+                    break
+                try:
+                    item = q.get(timeout=timeout)
+                except queue.Empty:
+                    break
+            else:
+                stopping = True
+
+            if batch:
+                connection = self._write(connection, batch)
+
+        if connection is not None:
+            connection.close()
+
+    def _write(self, connection, batch):
+        try:
+            if connection is None:
+                connection = self.connect()
+            cursor = connection.cursor()
+            try:
+                cursor.executemany(INSERT_QUERY, batch)
+                connection.commit()
+            finally:
+                cursor.close()
+            self.written += len(batch)
+        except Exception as e:
+            print(f"Error writing {len(batch)} analytics events: {e}")
+            self.dropped += len(batch)
+            try:
+                if connection is not None:
+                    connection.close()
+            except Exception:
+                pass
+            connection = None  # Reconnect on the next batch
+        return connection
+
+    def close(self, timeout=5):
+        # Flush what is queued and stop the thread; called at worker exit
+        self._worker.close(timeout)
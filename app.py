@@ -1,9 +1,28 @@
 import os
-from flask import Flask, request, jsonify, send_file
-from flask_mail import Mail
+import hmac
+import hashlib
+import functools
+import click
+from flask import Flask, Response, request, jsonify, send_file, json, url_for, stream_with_context, g
 from datetime import datetime
-from flask_mysqldb import MySQL
-from invoice_generator import generate_invoice
+import MySQLdb
+from db_pool import ConnectionPool
+from metrics import Metrics
+from query_profiler import QueryProfiler, QUERY_PROFILE
+from analytics_writer import AnalyticsWriter
+from invoice_numbers import InvoiceNumberAllocator
+import purchase_totals
+from cache_bus import CacheBus
+from profile_cache import ProfileCache
+from bloom_filter import KnownUsers, user_key
+from wishlist_cache import WishlistCache, WISHLIST_FIELDS, WISHLIST_BATCH_MAX, book_ids
+from catalog_cache import CatalogCache, make_payload, BOOKS_PAGE_SIZE, BOOKS_PAGE_MAX, PAGED_FACETS
+from book_search import SearchIndex, SEARCH_LIMIT, SEARCH_LIMIT_MAX
+from catalog_stream import FINDBOOKS_QUERIES, getbooks_queries, select_list, stream_listing
+from invoice_jobs import InvoiceJobs, PENDING, FAILED
+from invoice_store import InvoiceStore
+from invoice_export import export_invoices, stream_zip, unnumbered_purchases, EXPORT_PROCESSES
+from invoice_mailer import InvoiceMailer
 from io import BytesIO
 from flask_cors import CORS
 from dotenv import load_dotenv
@@ -21,7 +40,19 @@ app.config['MAIL_USERNAME'] = os.getenv('MAIL_USERNAME')
 app.config['MAIL_PASSWORD'] = os.getenv('MAIL_PASSWORD')
 app.config['MAIL_USE_SSL'] = os.getenv('MAIL_USE_SSL') == 'True'
 app.config['MAIL_USE_TLS'] = os.getenv('MAIL_USE_TLS') == 'True'
-mail = Mail(app)
+app.config['MAIL_DEFAULT_SENDER'] = os.getenv('MAIL_DEFAULT_SENDER', os.getenv('MAIL_USERNAME'))
+
+_mail = None
+
+
+def get_mail():
+    # Flask-Mail is only imported once something actually sends mail
+    global _mail
+    if _mail is None:
+        from flask_mail import Mail
+        _mail = Mail(app)
+    return _mail
+
 
 # MySQL Configuration
 app.config['MYSQL_HOST'] = os.getenv('MYSQL_HOST')
@@ -29,10 +60,150 @@ app.config['MYSQL_USER'] = os.getenv('MYSQL_USER')
 app.config['MYSQL_PASSWORD'] = os.getenv('MYSQL_PASSWORD')
 app.config['MYSQL_DB'] = os.getenv('MYSQL_DB')
 app.config['MYSQL_PORT'] = int(os.getenv('MYSQL_PORT'))
-mysql = MySQL(app)
+
+
+def connect_mysql():
+    # Same connection settings Flask-MySQLdb used
+    kwargs = {'port': app.config['MYSQL_PORT'], 'connect_timeout': 10, 'use_unicode': True, 'charset': 'utf8'}
+    for key, setting in (('host', 'MYSQL_HOST'), ('user', 'MYSQL_USER'), ('passwd', 'MYSQL_PASSWORD'), ('db', 'MYSQL_DB')):
+        if app.config[setting]:
+            kwargs[key] = app.config[setting]
+    return MySQLdb.connect(**kwargs)
+
+
+# Latency and DB-time histograms for /metrics, summed across workers
+metrics = Metrics()
+
+# Per-statement profiling (fingerprints, slow log with EXPLAIN, repeated queries); off unless QUERY_PROFILE=True
+query_profiler = QueryProfiler() if QUERY_PROFILE else None
+
+
+def wrap_cursor(cursor):
+    if query_profiler is not None:
+        cursor = query_profiler.wrap_cursor(cursor)
+    return metrics.wrap_cursor(cursor)
+
+
+# Connections shared by the requests of this worker; their cursors feed the DB timings
+db_pool = ConnectionPool(connect_mysql, wrap_cursor=wrap_cursor)
+
+
+def endpoint_label():
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+
+@app.before_request
+def start_timing():
+    metrics.begin()
+    if query_profiler is not None:
+        query_profiler.begin(f"{request.method} {endpoint_label()}")
+
+
+@app.after_request
+def note_status(response):
+    request.environ['metrics.status'] = response.status_code
+    report = query_profiler.report() if query_profiler is not None else None
+    if report is not None:
+        # A streamed body's queries run after this, so they only show in the dump
+        response.headers['X-Query-Profile'] = report
+    return response
+
+
+@app.teardown_request
+def record_timing(exception):
+    # Runs after a streamed body has been sent, so its time and queries count too
+    metrics.end(endpoint_label(), request.method, request.environ.get('metrics.status', 500))
+    if query_profiler is not None:
+        query_profiler.end()
+
+
+def get_db():
+    # One pooled connection per app context, checked out on first use
+    if 'db' not in g:
+        g.db = db_pool.acquire()
+    return g.db
+
+
+@app.teardown_appcontext
+def release_db(exception):
+    # Returns the connection and closes any cursor a view left open
+    db = g.pop('db', None)
+    if db is not None:
+        db.close()
+
+# Catalog snapshot shared by the book listing endpoints in this worker
+catalog = CatalogCache()
+
+# /search index over that snapshot, updated book by book when it is reloaded
+search_index = SearchIndex()
+
+# Invalidations published by the other workers on this host
+cache_bus = CacheBus()
+
+# Catalog edits made outside the API (imports, admin SQL) are announced with `flask reload-catalog`
+cache_bus.subscribe('catalog', lambda key: catalog.invalidate(), catalog.invalidate)
+
+# User profiles for /login, /check-user and /getbooks, kept fresh by the profile write endpoints
+profiles = ProfileCache()
+cache_bus.subscribe('profile', profiles.invalidate_key, profiles.clear)
+
+# Bloom filter of userIds and emails, so /check-user can reject unknown users without a query
+known_users = KnownUsers()
+cache_bus.subscribe('user', known_users.add, known_users.reset)
+
+# Wishlisted book ids per user; the book rows themselves come from the catalog snapshot
+wishlists = WishlistCache()
+cache_bus.subscribe('wishlist', wishlists.invalidate, wishlists.clear)
+
+
+@app.before_request
+def apply_invalidations():
+    cache_bus.poll()
+
+
+def invalidate_profile(user_id=None, email=None):
+    # Here and in every other worker
+    profiles.invalidate(user_id=user_id, email=email)
+    cache_bus.publish('profile', user_id and f"id:{user_id}", email and f"email:{email}")
+
+
+def wishlist_changed(user_id):
+    # This worker's set is already up to date; the others reload theirs
+    cache_bus.publish('wishlist', user_id)
+
+
+def add_known_user(user_id, email):
+    # Here and in every other worker
+    key = user_key(user_id, email)
+    known_users.add(key)
+    cache_bus.publish('user', key)
+
+
+# Hands out invoice numbers from blocks reserved per worker per day
+invoice_allocator = InvoiceNumberAllocator()
+
+
+# Batches analytics events off the request thread, on a dedicated connection
+analytics = AnalyticsWriter(connect_mysql)
+
+# Process pool for rendering invoices off the request worker
+invoice_jobs = InvoiceJobs()
+
+# Rendered invoices, kept on disk so they can be downloaded again
+invoice_store = InvoiceStore()
+INVOICE_ASYNC = os.getenv('INVOICE_ASYNC') == 'True'  # Default for /purchase when the client doesn't ask
+
+# Emails invoices from a background thread over one reused SMTP connection
+invoice_mailer = InvoiceMailer(app, get_mail, invoice_store)
+INVOICE_EMAIL = os.getenv('INVOICE_EMAIL') == 'True'  # Default for /purchase's emailInvoice
 
 # Secret Key
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
+if not app.config['SECRET_KEY']:
+    print("SECRET_KEY is not set; invoices can't be downloaded after purchase")
+
+# Bearer token for the admin-only endpoints; they are disabled while it is unset
+app.config['ADMIN_TOKEN'] = os.getenv('ADMIN_TOKEN')
 count = 2260
 
 @app.route('/', methods=['GET'])
@@ -44,36 +215,69 @@ def home():
 
 
 def generate_invoice_number():
-    current_date = datetime.now().strftime('%Y-%m-%d')  # Get today's date in YYYY-MM-DD format
-    cursor = mysql.connection.cursor()
+    # Served from this worker's reserved block; hits the database once per block
+    return invoice_allocator.next_number(get_db())
 
-    # Check if an entry exists for today's date
-    cursor.execute("SELECT last_counter FROM invoice_numbers WHERE date = %s", (current_date,))
-    result = cursor.fetchone()
 
-    if result:
-        # Increment the counter for today
-        last_counter = result[0] + 1
-        cursor.execute("UPDATE invoice_numbers SET last_counter = %s WHERE date = %s", (last_counter, current_date))
-    else:
-        # No entry for today, so start with counter 1
-        last_counter = 1
-        cursor.execute("INSERT INTO invoice_numbers (date, last_counter) VALUES (%s, %s)", (current_date, last_counter))
+def invoice_recipient(data, items):
+    # The address sent with the purchase, else the buyer's profile email
+    if data.get('email'):
+        return data['email']
+    user_id = items[0].get('userId') if items and items[0] else None
+    profile = profiles.get(get_db, user_id=user_id) if user_id else None
+    return profile['email'] if profile else None
+
 
-    mysql.connection.commit()
-    cursor.close()
+def admin_required(view):
+    # Authorization: Bearer <ADMIN_TOKEN>
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        expected = app.config['ADMIN_TOKEN']
+        if not expected:
+            return jsonify({'error': 'Admin endpoints are disabled; set ADMIN_TOKEN'}), 403
+        scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+        if scheme.lower() != 'bearer' or not hmac.compare_digest(token.strip().encode(), expected.encode()):
+            return jsonify({'error': 'Admin token required'}), 401, {'WWW-Authenticate': 'Bearer'}
+        return view(*args, **kwargs)
+    return wrapper
 
-    # Format the invoice number (UNB-YYYYMMDD-XXXX)
-    invoice_number = f"UNB-{datetime.now().strftime('%Y%m%d')}-{last_counter:04d}"
-    return invoice_number
+
+def invoice_token(invoice_number):
+    # Unguessable download key for one invoice; numbers themselves run in order.
+    # None without a SECRET_KEY: no links are issued and none are accepted.
+    secret = app.config['SECRET_KEY']
+    if not secret:
+        return None
+    return hmac.new(secret.encode(), invoice_number.encode(), hashlib.sha256).hexdigest()
+
+
+def invoice_url(invoice_number):
+    token = invoice_token(invoice_number)
+    return url_for('get_invoice', invoice_number=invoice_number, token=token) if token else None
 
 
 def log_event(user_id, event, metadata=None):
-    cursor = mysql.connection.cursor()
-    query = "INSERT INTO analytics (user_id, event, metadata) VALUES (%s, %s, %s)"
-    cursor.execute(query, (user_id, event, metadata))
-    mysql.connection.commit()
-    cursor.close()
+    # Queued for the background writer; never blocks on the database
+    analytics.log(user_id, event, metadata)
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/debug/queries', methods=['GET'])
+@admin_required
+def query_profile_dump():
+    # This worker's profile (raw SQL and timings, so admins only); 404 unless QUERY_PROFILE=True
+    if query_profiler is None:
+        return jsonify({'error': 'Query profiling is off'}), 404
+    return jsonify(query_profiler.dump()), 200
+
+@app.route('/db/pool', methods=['GET'])
+@admin_required
+def pool_stats():
+    # Checkout, wait-time and size counters for this worker's pool; admins only
+    return jsonify(db_pool.stats()), 200
+
 
 @app.route('/purchase', methods=['POST'])
 def handle_purchase():
@@ -87,93 +291,173 @@ def handle_purchase():
     purchases = data.get('purchases')  # List of books (book_code, quantity, unit_price, total_price)
     method = data.get('method')  # Payment method (type, account_name, account_number, pay_by)
     print(method)
-    # Generate an invoice number
-    invoice_number = generate_invoice_number()  # Ensure this function exists
-    
-    # Save purchases to the database
-    try:
-        cursor = mysql.connection.cursor()
-
-        if isinstance(purchasedDetails, list):
-            # Handle multiple purchases
-            for item in purchasedDetails:
-                user_id = item.get('userId')
-                book_id = item.get('bookId')
-                price = item.get('price')
-                payment_method = item.get('paymentMethod')
-                date_purchased = datetime.now()
-
-                cursor.execute(
-                    "INSERT INTO purchases (userId, bookId, price, paymentMethod, datePurchased) VALUES (%s, %s, %s, %s, %s)",
-                    (user_id, book_id, price, payment_method, date_purchased)
-                )
 
-        else:
-            # Handle a single purchase
-            user_id = purchasedDetails.get('userId')
-            book_id = purchasedDetails.get('bookId')
-            price = purchasedDetails.get('price')
-            payment_method = purchasedDetails.get('paymentMethod')
-            date_purchased = datetime.now()
-
-            cursor.execute(
-                "INSERT INTO purchases (userId, bookId, price, paymentMethod, datePurchased) VALUES (%s, %s, %s, %s, %s)",
-                (user_id, book_id, price, payment_method, date_purchased)
-            )
-
-        # Commit the transaction
-        mysql.connection.commit()
+    items = purchasedDetails if isinstance(purchasedDetails, list) else [purchasedDetails]
+    date_purchased = datetime.now()
+
+    # Take an invoice number and save every purchase row, with the buyer's
+    # running totals, in one transaction; executemany() sends the rows as a
+    # single multi-row INSERT
+    invoice_number = None
+    try:
+        invoice_number = generate_invoice_number()
+        rows = [
+            (item.get('userId'), item.get('bookId'), item.get('price'), item.get('paymentMethod'), date_purchased, invoice_number)
+            for item in items
+        ]
+        cursor = get_db().cursor()
+        purchase_totals.record(cursor, rows)
+        cursor.executemany(
+            "INSERT INTO purchases (userId, bookId, price, paymentMethod, datePurchased, invoiceNumber) VALUES (%s, %s, %s, %s, %s, %s)",
+            rows
+        )
+        get_db().commit()
         cursor.close()
 
     except Exception as e:
         print(f"Error inserting purchase data: {e}")
+        get_db().rollback()
+        if invoice_number:
+            invoice_allocator.release(invoice_number)
         return jsonify({'error': 'Failed to store purchase data'}), 500
 
-    # Generate the invoice PDF
+    # Whether to email the invoice too; it is sent in the background once rendered
+    email_to = None
+    if data.get('emailInvoice', INVOICE_EMAIL):
+        try:
+            email_to = invoice_recipient(data, items)
+        except Exception as e:
+            print(f"Error looking up invoice recipient: {e}")
+        if not email_to:
+            print(f"No email address for invoice {invoice_number}; not emailing it")
+
+    render_kwargs = dict(
+        customer_name=customer_name,
+        address=address,
+        date=date,
+        purchases=purchases,
+        method=method,
+        logo_path=None,  # Set your logo path here if available
+        stylish_ub_path=r"uni2.png"
+    )
+
+    # Async mode: hand the render to the pool and let the client poll for the PDF
+    queued = False
+    if data.get('async', INVOICE_ASYNC):
+        try:
+            future = invoice_jobs.submit(invoice_number, **render_kwargs)
+            queued = True
+            if email_to:
+                def email_when_rendered(done):
+                    # The PDF is in the store by now; the mailer reads it from there
+                    if done.exception() is None:
+                        invoice_mailer.send(email_to, invoice_number, customer_name=customer_name)
+
+                future.add_done_callback(email_when_rendered)
+        except Exception as e:
+            # The purchase is committed; render it here instead of failing the request
+            print(f"Error queueing invoice, rendering it inline: {e}")
+    if queued:
+        url = invoice_url(invoice_number)
+        return jsonify({'invoiceNumber': invoice_number, 'status': PENDING, 'invoiceUrl': url}), 202, \
+            {'Location': url} if url else {}
+
+    # Generate the invoice PDF; ReportLab is imported on the first render, not at worker boot
+    from invoice_generator import generate_invoice
     pdf_buffer = BytesIO()
 
     try:
         generate_invoice(
-            customer_name=customer_name,
-            address=address,
-            date=date,
-            purchases=purchases,
-            method=method,
             output_filename=pdf_buffer,  # Write directly to BytesIO object
             invoice_number=invoice_number,
-            logo_path=None,  # Set your logo path here if available
-            stylish_ub_path=r"uni2.png"
+            **render_kwargs
         )
     except Exception as e:
         print(f"Error generating invoice: {e}")
         return jsonify({'error': 'Failed to generate invoice'}), 500
 
+    try:
+        invoice_store.put(invoice_number, pdf_buffer.getvalue())
+    except Exception as e:
+        # The client still gets its PDF; it just can't be downloaded again later
+        print(f"Error storing invoice: {e}")
+
+    if email_to:
+        invoice_mailer.send(email_to, invoice_number, pdf_buffer.getvalue(), customer_name=customer_name)
+
     pdf_buffer.seek(0)  # Set the file pointer to the beginning
     try:
-        return send_file(pdf_buffer, as_attachment=True, download_name=f"invoice{invoice_number}.pdf", mimetype='application/pdf')
+        response = send_file(pdf_buffer, as_attachment=True, download_name=f"invoice{invoice_number}.pdf", mimetype='application/pdf')
+        url = invoice_url(invoice_number)
+        if url:
+            response.headers['X-Invoice-Url'] = url  # For downloading it again later
+        return response
     except Exception as e:
         print(f"Error sending invoice: {e}")
         return jsonify({'error': 'Failed to send invoice'}), 500
 
 
+@app.route('/invoice/<invoice_number>', methods=['GET'])
+def get_invoice(invoice_number):
+    # Stored PDFs are sent straight from disk (sendfile under gunicorn, with
+    # Range and conditional requests); 202 while an async render is running.
+    # Only with the ?token= handed out by /purchase, so numbers can't be enumerated.
+    expected = invoice_token(invoice_number)
+    if not expected or not hmac.compare_digest(request.args.get('token', '').encode(), expected.encode()):
+        return jsonify({'error': 'Invoice not found'}), 404
+
+    path, digest = invoice_store.get(invoice_number)
+    if path:
+        try:
+            return send_file(path, as_attachment=True, download_name=f"invoice{invoice_number}.pdf",
+                             mimetype='application/pdf', conditional=True, etag=digest)
+        except FileNotFoundError:
+            pass  # Evicted since the lookup
+
+    status = invoice_jobs.status(invoice_number)
+    if status == PENDING:
+        return jsonify({'invoiceNumber': invoice_number, 'status': PENDING}), 202, {'Retry-After': '1'}
+    if status == FAILED:
+        return jsonify({'error': 'Failed to generate invoice'}), 500
+    return jsonify({'error': 'Invoice not found'}), 404
+
+
+@app.route('/invoices/export', methods=['GET'])
+@admin_required
+def export_invoices_zip():
+    # ZIP of every invoice dated from..to (inclusive), streamed as it is built; admins only,
+    # since every invoice carries the buyer's name, address and account details
+    try:
+        start_day = datetime.strptime(request.args['from'], '%Y-%m-%d').date()
+        end_day = datetime.strptime(request.args.get('to') or request.args['from'], '%Y-%m-%d').date()
+    except (KeyError, ValueError):
+        return jsonify({'error': 'from (and optionally to) must be dates in YYYY-MM-DD format'}), 400
+    if end_day < start_day:
+        return jsonify({'error': 'to must not be before from'}), 400
+
+    unnumbered = unnumbered_purchases(get_db(), start_day, end_day)  # Listed in the manifest
+    # A pool across all cores for this export alone, stopped when the download ends (or is abandoned)
+    export_jobs = InvoiceJobs(EXPORT_PROCESSES)
+    invoices = export_invoices(get_db(), start_day, end_day, invoice_store, export_jobs,
+                               window=export_jobs.processes * 2)
+
+    def chunks():
+        try:
+            yield from stream_zip(invoices, unnumbered)
+        finally:
+            export_jobs.shutdown()
+
+    filename = f"invoices-{start_day:%Y%m%d}-{end_day:%Y%m%d}.zip"
+    return Response(stream_with_context(chunks()), mimetype='application/zip',
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+
 @app.route('/user/purchases', methods=['GET'])
 def get_purchase_summary():
     user_id = request.args.get('userId')  # Get the userId from query params
 
-    # SQL Query to sum the prices and count the number of books for the given user
-    query = """
-        SELECT SUM(price) as totalSum, COUNT(bookId) as totalBooks
-        FROM purchases 
-        WHERE userId = %s
-    """
-    cursor = mysql.connection.cursor()
-    cursor.execute(query, (user_id,))
-    result = cursor.fetchone()
-    cursor.close()
-
-    # If no purchases are found, return 0 for both fields
-    total_sum = result[0] if result[0] is not None else 0
-    total_books = result[1] if result[1] is not None else 0
+    # One keyed read of the totals /purchase keeps up to date
+    total_sum, total_books = purchase_totals.lookup(get_db(), user_id)
 
     # Return the result as JSON
     return jsonify({
@@ -181,6 +465,25 @@ def get_purchase_summary():
         'totalBooks': total_books
     })
 
+
+@app.cli.command('reload-catalog')
+def reload_catalog():
+    """Make every worker on this host reload the books catalog on its next request."""
+    cache_bus.publish('catalog', 'all')
+    click.echo('Catalog reload published')
+
+
+@app.cli.command('rebuild-purchase-totals')
+@click.option('--check', is_flag=True, help='Only report drift; leave user_purchase_totals as it is.')
+def rebuild_purchase_totals(check):
+    """Recompute user_purchase_totals from purchases and report any drift."""
+    drift = purchase_totals.rebuild(get_db(), check_only=check)
+    for user_id, stored, expected in drift:
+        click.echo(f"{user_id}: stored {stored}, purchases give {expected}")
+    click.echo(f"{len(drift)} user(s) {'drifted' if check else 'repaired'}")
+    if check and drift:
+        raise SystemExit(1)
+
 """
 CREATE TABLE purchases (
     purchaseId INT AUTO_INCREMENT PRIMARY KEY,   -- Unique ID for each purchase
@@ -189,9 +492,15 @@ CREATE TABLE purchases (
     price DECIMAL(10, 2) NOT NULL,               -- The price of the book
     paymentMethod VARCHAR(50) NOT NULL,          -- Payment method (e.g., Credit Card, PayPal, etc.)
     datePurchased DATETIME DEFAULT CURRENT_TIMESTAMP, -- Date and time of purchase
+    invoiceNumber VARCHAR(32) NULL,              -- Invoice the purchase was billed on (UNB-YYYYMMDD-XXXX)
+    INDEX (invoiceNumber),                       -- Used by the invoice export
     FOREIGN KEY (userId) REFERENCES users(userId),   -- Foreign key to users table
     FOREIGN KEY (bookId) REFERENCES books(id)        -- Foreign key to books table
 );
+
+-- Existing databases (rows from before this keep a NULL invoiceNumber; /invoices/export
+-- can't include them and only reports how many there are in its manifest.csv):
+ALTER TABLE purchases ADD COLUMN invoiceNumber VARCHAR(32) NULL, ADD INDEX (invoiceNumber);
 """
     
 
@@ -217,7 +526,7 @@ def complete_profile():
     # Connect to the database
     
     try:
-        cursor = mysql.connection.cursor()
+        cursor = get_db().cursor()
 
         # Insert the user data into the users table
         insert_query = """
@@ -225,7 +534,9 @@ def complete_profile():
         VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
         """
         cursor.execute(insert_query, (user_id, email, username, profile_url, level, flat_no, street, city, state, postal_code, phone, department))
-        mysql.connection.commit()
+        get_db().commit()
+        invalidate_profile(user_id, email)
+        add_known_user(user_id, email)
         log_event(user_id, 'CompleteProfile', 'User completed profile')
 
         # Respond with success
@@ -247,30 +558,28 @@ def login():
         if not email:
             return jsonify({'error': 'Email is required'}), 400
 
-        cursor = mysql.connection.cursor()
-        cursor.execute("SELECT username, level, profileUrl, address, phone, department,flatno, street, city, state, postalcode, haswelcomed FROM users WHERE email = %s", (email,))
-        user = cursor.fetchone()
+        user = profiles.get(get_db, email=email)
 
         if user:
             response = {
-                'name': user[0],
-                'level': user[1] or "",
-                'profileUrl': profile_url or user[2] or "",
-                'address': user[3] or "",
-                'phone': user[4] or "",
-                'department': user[5] or "",
-                'flat_no': user[6] or "",
-                'street': user[7] or "",
-                'city': user[8] or "",
-                'state': user[9] or "",
-                'postal_code': user[10] or "",
-                'haswelcomed': user[11] or False,
+                'name': user['username'],
+                'level': user['level'] or "",
+                'profileUrl': profile_url or user['profileUrl'] or "",
+                'address': user['address'] or "",
+                'phone': user['phone'] or "",
+                'department': user['department'] or "",
+                'flat_no': user['flatno'] or "",
+                'street': user['street'] or "",
+                'city': user['city'] or "",
+                'state': user['state'] or "",
+                'postal_code': user['postalcode'] or "",
+                'haswelcomed': user['haswelcomed'] or False,
                 'email': email,
                 'userId': user_id
             }
-            cursor.close()
             log_event(user_id, 'login', 'User logged in successfully')
             return jsonify(response), 200
+        return jsonify({'error': 'User not found'}), 404
     except Exception as e:
         print(e)
         return jsonify({'error': str(e)}), 500
@@ -286,28 +595,31 @@ def check_user():
         if not user_id and not email:
             return jsonify({'error': 'User ID or Email is required'}), 400
 
-        cursor = mysql.connection.cursor()
+        # A definite miss in the filter needs no query
+        if not known_users.might_exist(get_db, user_id=user_id, email=email):
+            return jsonify({'exists': False, 'message': 'User not found.'}), 404
 
         # Check if a user exists by userId or email
-        if user_id:
-            cursor.execute("SELECT * FROM users WHERE userId = %s", (user_id,))
-        elif email:
-            cursor.execute("SELECT * FROM users WHERE email = %s", (email,))
-        
-        user = cursor.fetchone()
-        cursor.close()
+        user = profiles.get(get_db, user_id=user_id, email=email)
 
         if user:
             # User exists
             return jsonify({'exists': True, 'message': 'User found.'}), 200
         else:
             # User does not exist
+            known_users.record_miss(user_id=user_id, email=email)
             return jsonify({'exists': False, 'message': 'User not found.'}), 404
 
     except Exception as e:
         log_event(user_id, 'error', str(e))
         return jsonify({'error': str(e)}), 500
 
+@app.route('/check-user/stats', methods=['GET'])
+@admin_required
+def check_user_stats():
+    # Size and false-positive rate of this worker's filter; admins only
+    return jsonify(known_users.stats()), 200
+
 @app.route('/profileavatar', methods=['PUT'])
 def profile_avatar():
     try:
@@ -317,7 +629,7 @@ def profile_avatar():
             return jsonify({'error': 'User ID is required'}), 400
         
         profile_url = data.get('profileUrl', '')
-        cursor = mysql.connection.cursor()
+        cursor = get_db().cursor()
 
         
         cursor.execute("""
@@ -326,8 +638,9 @@ def profile_avatar():
             WHERE userId = %s
         """, (profile_url, user_id))
 
-        mysql.connection.commit()
+        get_db().commit()
         cursor.close()
+        invalidate_profile(user_id)
         log_event(user_id, 'Update', 'Created User Profile Avatar')
 
         return jsonify({'message': 'User data updated successfully'}), 200
@@ -360,7 +673,7 @@ def update_user():
         street = data.get('street', '')
         state = data.get('state', '')
 
-        cursor = mysql.connection.cursor()
+        cursor = get_db().cursor()
 
         # Update user information in the database
         cursor.execute("""
@@ -369,8 +682,9 @@ def update_user():
             WHERE userId = %s
         """, (username, profile_url, level, postal_code, state, street, flat_no, city, phone, department, user_id))
 
-        mysql.connection.commit()
+        get_db().commit()
         cursor.close()
+        invalidate_profile(user_id)
         log_event(user_id, 'Update', 'User Updated Profile')
 
         return jsonify({'message': 'User data updated successfully'}), 200
@@ -380,111 +694,190 @@ def update_user():
         log_event(user_id, 'error', str(e))
         return jsonify({'error': str(e)}), 500
 
-@app.route('/getbooks', methods=['GET'])
-def get_books():
-    try:
-        user_id = request.args.get('userId')
-        cursor = mysql.connection.cursor()
-        print(f"User ID: {user_id}")
+def json_bytes(obj):
+    # Same output as jsonify() outside debug mode, kept as bytes so it can be cached
+    return (json.dumps(obj, separators=(',', ':')) + "\n").encode('utf-8')
 
-        # Fetch the department associated with the user
-        cursor.execute("SELECT department FROM users WHERE userId = %s", (user_id,))
-        department = cursor.fetchone()
-        print(f"Department: {department}")
 
-        if department:
-            department_name = department[0]
+def cached_json_response(payload):
+    # payload is a (body, etag) pair built once per catalog snapshot
+    body, etag = payload
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.cache_control.no_cache = True  # Clients keep the body but revalidate every time
+    return response
 
-            # Fetch books from the user's department
-            cursor.execute("SELECT * FROM books WHERE department = %s", (department_name,))
-            department_books = cursor.fetchall() 
-        else:
-            department_books = []
-        # Fetch the most recent books
-        cursor.execute("SELECT * FROM books ORDER BY id DESC LIMIT 10")
-        recent_choices = cursor.fetchall()
-        response = {
-            'allBooks': department_books,
-            'recentChoices': recent_choices
-        }
-        return jsonify(response), 200
-    except Exception as e:
-        print(f"Error: {str(e)}")
-        return jsonify({'error': str(e)}), 500
 
+def listing_args():
+    """Parse ?after=&limit=&fields= for the book listings.
 
-@app.route('/findbooks', methods=['GET'])
-def find_books():
+    Returns (paged, after, limit, fields); raises ValueError on bad input.
+    """
+    args = request.args
+    paged = 'after' in args or 'limit' in args
     try:
-        cursor = mysql.connection.cursor()
+        after = int(args['after']) if args.get('after') else None
+        limit = int(args['limit']) if args.get('limit') else BOOKS_PAGE_SIZE
+    except ValueError:
+        raise ValueError('after and limit must be integers')
+    if limit < 1:
+        raise ValueError('limit must be positive')
+    limit = min(limit, BOOKS_PAGE_MAX)
+    fields = tuple(field.strip() for field in args.get('fields', '').split(',') if field.strip())
+    return paged, after, limit, fields
+
+
+def listing_response(snapshot, key, build):
+    """Serve a listing built by build(after, limit, indexes) from the snapshot.
+
+    The plain request and first pages are cached on the snapshot; later pages
+    are small and serialized per request.
+    """
+    try:
+        paged, after, limit, fields = listing_args()
+        indexes = snapshot.projection(fields)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
-        cursor.execute("SELECT * FROM books")
-        allbooks = cursor.fetchall()
+    if not paged:
+        after = limit = None
+    serialize = lambda: json_bytes(build(after, limit, indexes))
+    if after is None:
+        return cached_json_response(snapshot.payload((key, limit, indexes), serialize))
+    return cached_json_response(make_payload(serialize()))
 
-        # Query for recent choices
-        cursor.execute("SELECT * FROM books ORDER BY id DESC LIMIT 10")
-        recent_choices = cursor.fetchall()
 
-        # Query for new arrivals
-        cursor.execute("SELECT * FROM books ORDER BY id DESC LIMIT 3")
-        new_arrivals = cursor.fetchall()
+def streamed_listing(queries):
+    """?stream=true: rows go from a server-side cursor to the client a batch at a time."""
+    try:
+        paged, _, _, fields = listing_args()
+        if paged:
+            raise ValueError('stream cannot be combined with after or limit')
+        columns = select_list(get_db(), fields)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
-        # Query for top-rated books (assuming a rating column exists)
-        cursor.execute("SELECT * FROM books ORDER BY rating DESC LIMIT 10")
-        top_rated_books = cursor.fetchall()
+    dumps = lambda obj: json.dumps(obj, separators=(',', ':'))
+    return Response(stream_with_context(stream_listing(get_db(), queries, columns, dumps)), mimetype='application/json')
 
-        # Query for books on sale (assuming a discount or price filter)
-        cursor.execute("SELECT * FROM books WHERE price < 2000")
-        on_sale_books = cursor.fetchall()
 
-        # Query for engineering books
-        cursor.execute("SELECT * FROM books WHERE department = 'art'")
-        arts_books = cursor.fetchall()
+def wants_stream():
+    return request.args.get('stream', '').lower() in ('1', 'true')
 
-        cursor.execute("SELECT * FROM books WHERE department = 'Engineering'")
-        engineering_books = cursor.fetchall()
 
-        cursor.execute("SELECT * FROM books WHERE department = 'it'")
-        it_books = cursor.fetchall()
+@app.route('/getbooks', methods=['GET'])
+def get_books():
+    try:
+        user_id = request.args.get('userId')
+        print(f"User ID: {user_id}")
 
-        cursor.execute("SELECT * FROM books WHERE department = 'geology'")
-        featured_books = cursor.fetchall()
+        # Fetch the department associated with the user
+        user = profiles.get(get_db, user_id=user_id) if user_id else None
+        department = (user['department'],) if user else None
+        print(f"Department: {department}")
 
-        # Query for science books
-        cursor.execute("SELECT * FROM books WHERE department IN ('Physics and Astronomy', 'Pure and Industrial Chemistry', 'Micro Biology')")
-        science_books = cursor.fetchall()
+        department_name = department[0] if department else None
+        if wants_stream():
+            return streamed_listing(getbooks_queries(department_name))
+        snapshot = catalog.get(get_db)
 
-        # Query for arts bo@FROM books ORDER BY views DESC LIMIT 3")
-        most_viewed_books = cursor.fetchall()
+        def build(after, limit, indexes):
+            if department is None:
+                department_books, next_cursor = [], None
+            elif limit is None:
+                department_books, next_cursor = snapshot.department_books(department_name), None
+            else:
+                department_books, next_cursor = snapshot.page(department_name, after, limit)
 
-        #  for popular books (e.g., based on views or sales)
-        cursor.execute("SELECT * FROM books ORDER BY views DESC LIMIT 3")
-        popular_books = cursor.fetchall()
+            response = {'allBooks': snapshot.project(department_books, indexes)}
+            if after is None:
+                response['recentChoices'] = snapshot.project(snapshot.facets['recentChoices'], indexes)
+            if limit is not None:
+                response['nextCursor'] = next_cursor
+            return response
 
-        cursor.close()
+        return listing_response(snapshot, ('getbooks', department_name), build)
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
 
-        # Construct the response
-        response = {
-            'allBooks': allbooks,
-            'recentChoices': recent_choices,
-            'newArrivals': new_arrivals,
-            'topRatedBooks': top_rated_books,
-            'onSaleBooks': on_sale_books,
-            'engineeringBooks': engineering_books,
-            'scienceBooks': science_books,
-            'artsBooks': arts_books,
-            'itBooks': it_books,
-            'featuredBooks': featured_books,
-            'mostViewedBooks': most_viewed_books,
-            'popularBooks': popular_books
-        }
 
-        return jsonify(response), 200
+@app.route('/findbooks', methods=['GET'])
+def find_books():
+    try:
+        if wants_stream():
+            return streamed_listing(FINDBOOKS_QUERIES)
+
+        # Every facet is built from the in-memory catalog snapshot, so a warm
+        # cache answers without touching the database
+        snapshot = catalog.get(get_db)
+
+        # ?facet= pages one of the facets that grow with the catalog; allBooks by default
+        facet = request.args.get('facet')
+        if facet is not None and facet not in PAGED_FACETS:
+            return jsonify({'error': f"facet must be one of: {', '.join(PAGED_FACETS)}"}), 400
+
+        def build(after, limit, indexes):
+            if limit is None:
+                # Not paginated: every facet in full
+                return {name: snapshot.project(rows, indexes) for name, rows in snapshot.facets.items()}
+            if after is not None or facet is not None:
+                name = facet or 'allBooks'
+                rows, next_cursor = snapshot.facet_page(name, after, limit)
+                return {name: snapshot.project(rows, indexes), 'nextCursor': next_cursor}
+
+            # First page: the fixed top-N facets whole, the growing ones up to `limit`
+            # rows each, with a cursor per facet for ?facet=<name>&after=
+            response = {}
+            next_cursors = {}
+            for name, rows in snapshot.facets.items():
+                if name in PAGED_FACETS:
+                    rows, next_cursors[name] = snapshot.facet_page(name, None, limit)
+                response[name] = snapshot.project(rows, indexes)
+            response['nextCursor'] = next_cursors['allBooks']
+            response['nextCursors'] = next_cursors
+            return response
+
+        return listing_response(snapshot, ('findbooks', facet), build)
 
     except Exception as e:
         print(e)
         return jsonify({'error': str(e)}), 500
 
+@app.route('/search', methods=['GET'])
+def search_books():
+    """Typeahead search: ?q=<words or prefixes>&limit=&fields=."""
+    try:
+        query = request.args.get('q', '')
+        try:
+            limit = int(request.args.get('limit') or SEARCH_LIMIT)
+        except ValueError:
+            return jsonify({'error': 'limit must be an integer'}), 400
+        limit = max(1, min(limit, SEARCH_LIMIT_MAX))
+
+        snapshot = catalog.get(get_db)  # No query at all while the snapshot is fresh
+        try:
+            fields = tuple(field.strip() for field in request.args.get('fields', '').split(',') if field.strip())
+            indexes = snapshot.projection(fields)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        search_index.sync(snapshot)
+        rows, total = search_index.search(query, limit)
+        return jsonify({'results': snapshot.project(rows, indexes), 'total': total}), 200
+    except Exception as e:
+        print(e)
+        return jsonify({'error': str(e)}), 500
+
+
+def wishlist_rows(snapshot, ids):
+    # Same columns (and order) the books JOIN wishlists query returned
+    return snapshot.project(snapshot.books(ids), snapshot.projection(WISHLIST_FIELDS))
+
+
 @app.route('/addToWishlist', methods=['POST'])
 def addToWishlist():
     data = request.get_json()
@@ -494,19 +887,16 @@ def addToWishlist():
     try:
     
         if user_id and book_id:
-            cursor = mysql.connection.cursor()
-            
-            # Check if the book is already in the wishlist
-            cursor.execute("SELECT * FROM wishlists WHERE userId = %s AND bookId = %s", (user_id, book_id))
-            existing_item = cursor.fetchone()
-            
-            if existing_item:
+            try:
+                book_id, = book_ids([book_id])
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+
+            # Set lookup first; add() also checks the table for a row that is already there
+            if not wishlists.add(get_db, user_id, [book_id]):
                 return jsonify({'message': 'Book already Exist'}), 409
-            else:
-                # Insert the new book into the wishlist
-                cursor.execute("INSERT INTO wishlists (userId, bookId) VALUES (%s, %s)", (user_id, book_id))
-                mysql.connection.commit()
-                return jsonify({'message': 'book added to wishlist successfully'}), 200
+            wishlist_changed(user_id)
+            return jsonify({'message': 'book added to wishlist successfully'}), 200
         else:
             return jsonify({'message': 'Userid and bookid required'}), 405
     except Exception as e:
@@ -521,21 +911,16 @@ def handle_remove_from_wishlist():
         book_id = request.args.get('bookId')
 
         if user_id and book_id:
-            cursor = mysql.connection.cursor()
-            cursor.execute("DELETE FROM wishlists WHERE userId = %s AND bookId = %s", (user_id, book_id))
-            mysql.connection.commit()
-            cursor.execute("""
-                SELECT books.id, books.code, books.title, books.department, 
-                       books.price, books.available, books.level, 
-                       books.rating, books.category  
-                FROM books 
-                JOIN wishlists ON books.id = wishlists.bookid 
-                WHERE wishlists.userId = %s
-            """, (user_id,))
-            
-            wishlist_items = cursor.fetchall()
-            cursor.close()
-            return jsonify(wishlist_items), 200
+            try:
+                ids = book_ids([book_id])
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            wishlists.remove(get_db, user_id, ids)
+            wishlist_changed(user_id)
+
+            # Still the whole list, as clients expect, but built from memory
+            snapshot = catalog.get(get_db)
+            return jsonify(wishlist_rows(snapshot, wishlists.get(get_db, user_id))), 200
         else:
             return jsonify({'error': 'User ID and Book ID are required'}), 400  # 400 Bad Request for missing parameters
     except Exception as e:
@@ -550,26 +935,118 @@ def handle_get_wishlist():
         print(f"get wishlist invoked {user_id}")
         
         if user_id:
-            cursor = mysql.connection.cursor()
-            cursor.execute("""
-                SELECT books.id, books.code, books.title, books.department, 
-                       books.price, books.available, books.level, 
-                       books.rating, books.category  
-                FROM books 
-                JOIN wishlists ON books.id = wishlists.bookid 
-                WHERE wishlists.userId = %s
-            """, (user_id,))
-            
-            wishlist_items = cursor.fetchall()
-            cursor.close()
-            
-            return jsonify(wishlist_items), 200
+            snapshot = catalog.get(get_db)
+            return jsonify(wishlist_rows(snapshot, wishlists.get(get_db, user_id))), 200
         else:
             return jsonify({'error': 'User ID is required'}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/wishlist/batch', methods=['POST'])
+def handle_wishlist_batch():
+    """Add and remove several books in one call.
+
+    Body: {"userId": ..., "add": [bookId, ...], "remove": [bookId, ...], "full": false}.
+    Removals are applied before additions. Responds with the change only:
+    rows for the books actually added and ids of the books actually
+    removed. "full": true also returns the whole wishlist.
+    """
+    try:
+        data = request.get_json() or {}
+        if not isinstance(data, dict):
+            return jsonify({'error': 'Body must be a JSON object'}), 400
+        user_id = data.get('userId')
+        if not user_id:
+            return jsonify({'error': 'User ID is required'}), 400
+        try:
+            to_add = book_ids(data.get('add') or [])
+            to_remove = book_ids(data.get('remove') or [])
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if len(to_add) + len(to_remove) > WISHLIST_BATCH_MAX:
+            return jsonify({'error': f'At most {WISHLIST_BATCH_MAX} book ids per request'}), 400
+
+        removed = wishlists.remove(get_db, user_id, to_remove) if to_remove else []
+        added = wishlists.add(get_db, user_id, to_add) if to_add else []
+        if to_add or to_remove:
+            wishlist_changed(user_id)
+
+        snapshot = catalog.get(get_db)
+        response = {'added': wishlist_rows(snapshot, added), 'removed': removed}
+        if data.get('full'):
+            response['wishlist'] = wishlist_rows(snapshot, wishlists.get(get_db, user_id))
+        return jsonify(response), 200
+    except Exception as e:
+        print(e)
+        return jsonify({'error': str(e)}), 500
+
+
+BATCH_MAX_REQUESTS = int(os.getenv('BATCH_MAX_REQUESTS', 20))
+
+
+def run_subrequest(sub):
+    """Dispatch one /batch entry through the normal routing; returns (status, headers, body bytes or None)."""
+    path = sub.get('path') or ''
+    method = sub.get('method') or 'GET'
+    extra_headers = sub.get('headers') or {}
+    if not isinstance(path, str) or not path.startswith('/') or path.split('?')[0].rstrip('/') == '/batch':
+        return 400, {}, json_bytes({'error': 'Invalid path'})
+    if not isinstance(method, str):
+        return 400, {}, json_bytes({'error': 'method must be a string'})
+    if not isinstance(extra_headers, dict) or not all(
+            isinstance(key, str) and isinstance(value, str) for key, value in extra_headers.items()):
+        return 400, {}, json_bytes({'error': 'headers must be an object of strings'})
+    method = method.upper()
+
+    headers = {key: value for key, value in request.headers.items()
+               if key.lower() not in ('content-type', 'content-length', 'if-none-match')}
+    headers.update(extra_headers)
+    kwargs = {'json': sub['body']} if 'body' in sub else {}
+    # Nested request contexts reuse the current app context, so g.db (one
+    # pooled connection) and the per-worker caches are shared by every entry
+    with app.test_request_context(path, base_url=request.host_url, method=method, headers=headers, **kwargs):
+        try:
+            response = app.full_dispatch_request()
+        except Exception as e:
+            print(f"Error in batch entry {method} {path}: {e}")
+            return 500, {}, json_bytes({'error': str(e)})
+        body = response.get_data()
+        response.close()
+
+    result_headers = {'ETag': response.headers['ETag']} if 'ETag' in response.headers else {}
+    if response.status_code == 304 or not body:
+        return response.status_code, result_headers, None
+    if not response.is_json:
+        error = response.status if response.status_code >= 400 else 'Response is not JSON; request it directly'
+        return response.status_code, result_headers, json_bytes({'error': error})
+    return response.status_code, result_headers, body
+
+
+@app.route('/batch', methods=['POST'])
+def handle_batch():
+    """Run several API calls in one round trip.
+
+    Body: {"requests": [{"method": "GET", "path": "/getWishlist?userId=...",
+    "body": {...}, "headers": {...}}, ...]}. Entries run in order on one
+    database connection. The response holds one {"status", "headers",
+    "body"} per entry, in the same order; a 304 or empty response has a
+    null body. An entry with a malformed path, method or headers gets a
+    400 of its own, and the rest still run.
+    """
+    data = request.get_json(silent=True)
+    subrequests = data.get('requests') if isinstance(data, dict) else None
+    if not isinstance(subrequests, list) or not all(isinstance(sub, dict) for sub in subrequests):
+        return jsonify({'error': 'requests must be a list of objects'}), 400
+    if len(subrequests) > BATCH_MAX_REQUESTS:
+        return jsonify({'error': f'At most {BATCH_MAX_REQUESTS} requests per batch'}), 400
+
+    # Sub-responses are already JSON; splice their bytes in rather than parse and re-encode them
+    parts = []
+    for sub in subrequests:
+        status, headers, body = run_subrequest(sub)
+        parts.append(b'{"status":%d,"headers":%s,"body":%s}' % (status, json_bytes(headers).rstrip(), body.rstrip() if body else b'null'))
+    return app.response_class(b'{"responses":[' + b','.join(parts) + b']}\n', mimetype='application/json')
 
 
 if __name__ == '__main__':
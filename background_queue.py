@@ -0,0 +1,50 @@
+"""A queue drained by a daemon thread of its own, for work done off the request path.
+
+The thread is started on first use rather than at import, and started
+again (with a fresh queue) the first time it is used in a forked child,
+since threads don't survive fork(): gunicorn imports the app in the
+master and forks the workers. close() puts STOP on the queue and waits
+for the thread; it is registered with atexit, so whatever is queued when
+a worker exits is still handled.
+"""
+import atexit
+import os
+import queue
+import threading
+
+STOP = object()  # Put on the queue by close(); the target returns when it gets it
+
+
+class BackgroundQueue(object):
+
+    def __init__(self, target, name, maxsize=0):
+        self.target = target  # Runs on the thread as target(queue)
+        self.name = name
+        self.maxsize = maxsize
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def ensure_started(self):
+        """This process's queue, starting its thread if it isn't running here yet."""
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._queue = queue.Queue(self.maxsize)
+                    self._thread = threading.Thread(target=self.target, args=(self._queue,),
+                                                    name=self.name, daemon=True)
+                    self._thread.start()
+                    self._pid = os.getpid()
+        return self._queue
+
+    def close(self, timeout=5):
+        # Let the thread finish what is queued, then stop it; called at worker exit
+        if self._pid != os.getpid() or not self._thread.is_alive():
+            return
+        try:
+            self._queue.put(STOP, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
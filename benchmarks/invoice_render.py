@@ -0,0 +1,135 @@
+"""Invoice rendering benchmark.
+
+Renders carts of 1, 10, 100 and 1000 line items, with and without the
+uni2.png logo, through generate_invoice() the way a worker does (renderer
+warmed up, PDF written to memory). For each case it reports the median
+render time, output size and peak traced memory. Results are written as
+JSON and can be checked against a saved baseline:
+
+    python benchmarks/invoice_render.py --runs 10 --output invoice_render.json
+    python benchmarks/invoice_render.py --baseline invoice_render.json --tolerance 0.2
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+from io import BytesIO
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from invoice_generator import generate_invoice  # noqa: E402
+
+CART_SIZES = (1, 10, 100, 1000)
+LOGO_PATH = os.path.join(ROOT, 'uni2.png')
+
+METHOD = {
+    'type': 'Bank Transfer',
+    'account_name': 'John Doe',
+    'account_number': '0123 4567 8901',
+    'pay_by': '23 June 2023',
+}
+
+
+def cart(lines):
+    purchases = []
+    for i in range(lines):
+        quantity = i % 3 + 1
+        unit_price = 500 + (i * 37) % 4500
+        purchases.append({'book_code': f"BK{i:05d}", 'quantity': quantity, 'unit_price': unit_price,
+                          'total_price': quantity * unit_price})
+    return purchases
+
+
+def render(purchases, logo):
+    output = BytesIO()
+    method = dict(METHOD, tax=round(sum(line['total_price'] for line in purchases) * 0.10, 2))
+    generate_invoice(customer_name='John Doe', address='123 Anywhere St., Any City', date='2024-09-19',
+                     method=method, purchases=purchases, output_filename=output, invoice_number='UNB-20240919-0001',
+                     stylish_ub_path=logo)
+    return len(output.getvalue())
+
+
+def measure(lines, logo, runs):
+    purchases = cart(lines)
+    render(purchases, logo)  # Builds the renderer (styles, decoded logo) as a worker's first invoice would
+
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        size = render(purchases, logo)
+        timings.append(time.perf_counter() - start)
+
+    # Traced separately: tracemalloc slows allocation-heavy code too much to time under it
+    tracemalloc.start()
+    try:
+        render(purchases, logo)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'lines': lines,
+        'logo': logo is not None,
+        'median_ms': statistics.median(timings) * 1000,
+        'min_ms': min(timings) * 1000,
+        'max_ms': max(timings) * 1000,
+        'size_bytes': size,
+        'peak_kib': peak / 1024,
+    }
+
+
+def regressions(results, baseline, tolerance, memory_tolerance):
+    found = []
+    for name, base in baseline['cases'].items():
+        current = results['cases'].get(name)
+        if current is None:
+            continue
+        for key, allowed in (('median_ms', tolerance), ('peak_kib', memory_tolerance)):
+            limit = base[key] * (1 + allowed)
+            if current[key] > limit:
+                found.append(f"{name}: {key} {current[key]:.1f} > {limit:.1f} allowed (baseline {base[key]:.1f})")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10, help='Timed renders per case')
+    parser.add_argument('--sizes', default=','.join(map(str, CART_SIZES)), help='Comma-separated cart sizes')
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--baseline', help='Fail if a case is slower, or peaks higher, than in this saved result')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed slowdown over the baseline (0.2 = 20%%)')
+    parser.add_argument('--memory-tolerance', type=float, default=0.1, help='Allowed growth in peak memory')
+    args = parser.parse_args()
+
+    cases = {}
+    for lines in (int(size) for size in args.sizes.split(',')):
+        for logo in (None, LOGO_PATH):
+            name = f"{lines} lines, {'logo' if logo else 'no logo'}"
+            cases[name] = measure(lines, logo, args.runs)
+            print(f"{name}: {cases[name]['median_ms']:.1f} ms, {cases[name]['size_bytes']} bytes, "
+                  f"{cases[name]['peak_kib']:.0f} KiB peak", file=sys.stderr)
+
+    results = {'runs': args.runs, 'cases': cases}
+    print(json.dumps(results, indent=2))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        found = regressions(results, baseline, args.tolerance, args.memory_tolerance)
+        for line in found:
+            print(f"Regressed: {line}", file=sys.stderr)
+        if found:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,274 @@
+"""Local load test: seeded database, real gunicorn, the locustfile's task mix.
+
+Creates (or resets) a dedicated MySQL database with a generated catalog
+and user base, boots `app:app` under gunicorn against it, runs the
+UserBehavior mix from locustfile.py headless, and writes p50/p95/p99
+latency and throughput per endpoint as JSON. With --baseline it exits
+non-zero when any endpoint's latency has regressed past the tolerance.
+
+Needs a MySQL server (MYSQL_HOST, MYSQL_PORT, MYSQL_USER, MYSQL_PASSWORD,
+as for the app) and locust (`pip install locust`). Every table in
+--database is dropped and recreated, so never point it at real data.
+
+    python benchmarks/loadtest.py --books 5000 --users 1000 --duration 60 --output load.json
+    python benchmarks/loadtest.py --baseline load.json --tolerance 0.25
+"""
+import argparse
+import csv
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import MySQLdb
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIRST_USER_ID = 1000
+
+DEPARTMENTS = ('Engineering', 'art', 'it', 'geology', 'Physics and Astronomy', 'Pure and Industrial Chemistry',
+               'Micro Biology', 'Economics', 'Law', 'Medicine')
+LEVELS = ('100', '200', '300', '400', '500')
+CATEGORIES = ('textbook', 'handout', 'past questions', 'manual')
+TITLE_WORDS = ('Introduction', 'Principles', 'Advanced', 'Applied', 'Calculus', 'Mechanics', 'Thermodynamics',
+               'Programming', 'Anatomy', 'Statistics', 'Geology', 'Design', 'Theory', 'Analysis', 'Systems')
+
+# Every table the app uses; all dropped before SCHEMA recreates them
+TABLES = ('user_purchase_totals', 'wishlists', 'purchases', 'analytics', 'invoice_numbers', 'users', 'books')
+
+SCHEMA = (
+    """CREATE TABLE books (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        code VARCHAR(32) NOT NULL,
+        title VARCHAR(255) NOT NULL,
+        department VARCHAR(255),
+        price DECIMAL(10, 2),
+        available INT,
+        level VARCHAR(16),
+        rating FLOAT,
+        category VARCHAR(64),
+        views INT DEFAULT 0,
+        INDEX (department)
+    )""",
+    """CREATE TABLE users (
+        userId VARCHAR(255) PRIMARY KEY,
+        email VARCHAR(255) UNIQUE,
+        username VARCHAR(255), profileUrl VARCHAR(512), level VARCHAR(16), address VARCHAR(255),
+        phone VARCHAR(32), department VARCHAR(255), flatNo VARCHAR(32), street VARCHAR(255),
+        city VARCHAR(255), state VARCHAR(255), postalCode VARCHAR(32), haswelcomed BOOLEAN DEFAULT FALSE
+    )""",
+    """CREATE TABLE invoice_numbers (
+        date DATE PRIMARY KEY,
+        last_counter INT NOT NULL
+    )""",
+    """CREATE TABLE analytics (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        user_id VARCHAR(255), event VARCHAR(255), metadata TEXT,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )""",
+    """CREATE TABLE purchases (
+        purchaseId INT AUTO_INCREMENT PRIMARY KEY,
+        userId VARCHAR(255) NOT NULL,
+        bookId INT NOT NULL,
+        price DECIMAL(10, 2) NOT NULL,
+        paymentMethod VARCHAR(50) NOT NULL,
+        datePurchased DATETIME DEFAULT CURRENT_TIMESTAMP,
+        invoiceNumber VARCHAR(32) NULL,
+        INDEX (invoiceNumber),
+        INDEX (userId),
+        FOREIGN KEY (bookId) REFERENCES books(id)
+    )""",
+    """CREATE TABLE wishlists (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        userId VARCHAR(255) NOT NULL,
+        bookId INT NOT NULL,
+        INDEX (userId, bookId)
+    )""",
+    """CREATE TABLE user_purchase_totals (
+        userId VARCHAR(255) NOT NULL PRIMARY KEY,
+        totalSum DECIMAL(14, 2) NOT NULL DEFAULT 0,
+        totalBooks INT NOT NULL DEFAULT 0
+    )""",
+)
+
+
+def connect():
+    kwargs = {'port': int(os.getenv('MYSQL_PORT', 3306)), 'charset': 'utf8'}
+    for key, name in (('host', 'MYSQL_HOST'), ('user', 'MYSQL_USER'), ('passwd', 'MYSQL_PASSWORD')):
+        if os.getenv(name):
+            kwargs[key] = os.getenv(name)
+    return MySQLdb.connect(**kwargs)
+
+
+def seed(database, books, users, rng):
+    """Recreate every table in `database` and fill books and users."""
+    connection = connect()
+    cursor = connection.cursor()
+    # utf8 with its case-insensitive default collation, like the production schema
+    cursor.execute(f"CREATE DATABASE IF NOT EXISTS `{database}`")
+    cursor.execute(f"ALTER DATABASE `{database}` CHARACTER SET utf8 COLLATE utf8_general_ci")
+    cursor.execute(f"USE `{database}`")
+    cursor.execute("SET FOREIGN_KEY_CHECKS = 0")
+    for table in TABLES:
+        cursor.execute(f"DROP TABLE IF EXISTS `{table}`")
+    cursor.execute("SET FOREIGN_KEY_CHECKS = 1")
+    for statement in SCHEMA:
+        cursor.execute(statement)
+
+    rows = []
+    for book_id in range(1, books + 1):
+        title = ' '.join(rng.sample(TITLE_WORDS, 3))
+        rows.append((book_id, f"BK{book_id:05d}", title, rng.choice(DEPARTMENTS), round(rng.uniform(500, 6000), 2),
+                     rng.randint(0, 20), rng.choice(LEVELS), round(rng.uniform(0, 5), 1), rng.choice(CATEGORIES),
+                     rng.randint(0, 5000)))
+    for start in range(0, len(rows), 1000):
+        cursor.executemany(
+            "INSERT INTO books (id, code, title, department, price, available, level, rating, category, views) "
+            "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)", rows[start:start + 1000])
+
+    rows = []
+    for number in range(FIRST_USER_ID, FIRST_USER_ID + users):
+        user_id = f"user_{number}"
+        rows.append((user_id, f"{user_id}@example.com", 'testuser', rng.choice(LEVELS), rng.choice(DEPARTMENTS)))
+    for start in range(0, len(rows), 1000):
+        cursor.executemany("INSERT INTO users (userId, email, username, level, department) VALUES (%s, %s, %s, %s, %s)",
+                           rows[start:start + 1000])
+    connection.commit()
+    cursor.close()
+    connection.close()
+
+
+def start_app(env, port, workers):
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', 'app:app', '--workers', str(workers), '--bind', f"127.0.0.1:{port}"],
+        cwd=ROOT, env=env)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with {process.returncode}")
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/", timeout=1).read()
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError('gunicorn did not start answering within 30s')
+
+
+def run_locust(env, host, users, spawn_rate, duration, csv_prefix):
+    # Locust exits 1 when any request failed; the failures are in the stats, so that isn't an error here
+    subprocess.run(
+        [sys.executable, '-m', 'locust', '-f', os.path.join(ROOT, 'locustfile.py'), '--headless', '--only-summary',
+         '--users', str(users), '--spawn-rate', str(spawn_rate), '--run-time', f"{duration}s",
+         '--host', host, '--csv', csv_prefix],
+        cwd=ROOT, env=env, check=False)
+
+
+def read_stats(csv_prefix):
+    """Per-endpoint results from locust's <prefix>_stats.csv, keyed "METHOD /route"."""
+    results = {}
+    with open(f"{csv_prefix}_stats.csv", newline='') as f:
+        for row in csv.DictReader(f):
+            key = 'total' if row['Name'] == 'Aggregated' else f"{row['Type']} {row['Name']}"
+            results[key] = {
+                'requests': int(row['Request Count']),
+                'failures': int(row['Failure Count']),
+                'p50_ms': float(row['50%']),
+                'p95_ms': float(row['95%']),
+                'p99_ms': float(row['99%']),
+                'rps': float(row['Requests/s']),
+            }
+    return results
+
+
+def regressions(results, baseline, metric, tolerance, min_requests):
+    found = []
+    for key, base in baseline['endpoints'].items():
+        current = results.get(key)
+        if current is None or current['requests'] < min_requests or base['requests'] < min_requests:
+            continue  # Too few samples for a percentile to mean anything
+        limit = base[metric] * (1 + tolerance)
+        if current[metric] > limit:
+            found.append(f"{key}: {metric} {current[metric]:.0f} ms > {limit:.0f} ms allowed (baseline {base[metric]:.0f} ms)")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', default='unibooks_loadtest', help='Dedicated database; its tables are dropped')
+    parser.add_argument('--books', type=int, default=2000, help='Books in the seeded catalog')
+    parser.add_argument('--users', type=int, default=500, help='Seeded users; as many unknown ids are also used')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed for the generated data')
+    parser.add_argument('--skip-seed', action='store_true', help='Reuse the database as it is')
+    parser.add_argument('--clients', type=int, default=50, help='Concurrent simulated users')
+    parser.add_argument('--spawn-rate', type=float, default=10)
+    parser.add_argument('--duration', type=int, default=60, help='Seconds to run')
+    parser.add_argument('--wait', default='1,5', help='Think time between tasks in seconds, "min,max"')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers')
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--baseline', help='Fail if an endpoint is slower than in this saved result')
+    parser.add_argument('--metric', default='p95_ms', choices=('p50_ms', 'p95_ms', 'p99_ms'))
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed slowdown over the baseline (0.25 = 25%%)')
+    parser.add_argument('--min-requests', type=int, default=20, help='Ignore endpoints with fewer requests than this')
+    args = parser.parse_args()
+
+    if not args.skip_seed:
+        seed(args.database, args.books, args.users, random.Random(args.seed))
+
+    scratch = tempfile.mkdtemp(prefix='unibooks-loadtest-')
+    host = f"http://127.0.0.1:{args.port}"
+    env = dict(os.environ)
+    env.update({
+        'MYSQL_DB': args.database,
+        'MYSQL_PORT': os.getenv('MYSQL_PORT', '3306'),
+        'MAIL_PORT': os.getenv('MAIL_PORT', '465'),
+        'SECRET_KEY': os.getenv('SECRET_KEY', 'loadtest'),
+        # Keep this run's caches, invoices and metrics apart from anything else on the machine
+        'CACHE_BUS_PATH': os.path.join(scratch, 'cache-bus.log'),
+        'INVOICE_JOB_DIR': os.path.join(scratch, 'invoice-jobs'),
+        'INVOICE_STORE_DIR': os.path.join(scratch, 'invoice-store'),
+        'METRICS_DIR': os.path.join(scratch, 'metrics'),
+        'LOAD_TEST_HOST': host,
+        'LOAD_TEST_BOOK_IDS': f"1-{args.books}",
+        # Half the ids exist, so both the known-user and unknown-user paths get exercised
+        'LOAD_TEST_USER_IDS': f"{FIRST_USER_ID}-{FIRST_USER_ID + 2 * args.users - 1}",
+        'LOAD_TEST_WAIT': args.wait,
+    })
+
+    app = start_app(env, args.port, args.workers)
+    try:
+        csv_prefix = os.path.join(scratch, 'locust')
+        run_locust(env, host, args.clients, args.spawn_rate, args.duration, csv_prefix)
+        endpoints = read_stats(csv_prefix)
+    finally:
+        app.terminate()
+        app.wait(timeout=30)
+
+    results = {
+        'config': {key: getattr(args, key) for key in ('books', 'users', 'seed', 'clients', 'duration', 'wait', 'workers')},
+        'endpoints': {key: value for key, value in endpoints.items() if key != 'total'},
+        'total': endpoints.get('total'),
+    }
+    print(json.dumps(results, indent=2))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        found = regressions(results['endpoints'], baseline, args.metric, args.tolerance, args.min_requests)
+        for line in found:
+            print(f"Regressed: {line}", file=sys.stderr)
+        if found:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
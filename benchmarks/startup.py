@@ -0,0 +1,87 @@
+"""Cold-start benchmark for `app:app`.
+
+Imports the app the way a fresh gunicorn worker does, once per run in a new
+interpreter, and reports the wall time. Results are written as JSON and can
+be checked against a saved baseline:
+
+    python benchmarks/startup.py --runs 15 --output startup.json
+    python benchmarks/startup.py --baseline startup.json --tolerance 0.2
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# app.py reads these at import time; placeholders are enough since nothing connects
+PLACEHOLDER_ENV = {
+    'MAIL_PORT': '465',
+    'MYSQL_PORT': '3306',
+    'SECRET_KEY': 'benchmark',
+}
+
+IMPORT_SNIPPET = (
+    "import time; start = time.perf_counter(); "
+    "from app import app; "
+    "print(time.perf_counter() - start)"
+)
+
+
+def run_once(env):
+    output = subprocess.check_output([sys.executable, '-c', IMPORT_SNIPPET], cwd=ROOT, env=env)
+    return float(output.decode().strip().splitlines()[-1])
+
+
+def slowest_imports(env, count=10):
+    # Self time per module from -X importtime, largest first
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'from app import app'],
+                            cwd=ROOT, env=env, capture_output=True, text=True, check=True)
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        modules.append({'module': name.strip(), 'self_ms': int(self_us) / 1000, 'cumulative_ms': int(cumulative_us) / 1000})
+    return sorted(modules, key=lambda module: module['self_ms'], reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--baseline', help='Fail if the median is slower than this saved result')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed slowdown over the baseline (0.2 = 20%%)')
+    args = parser.parse_args()
+
+    env = dict(PLACEHOLDER_ENV, **os.environ)
+    run_once(env)  # Warm the OS file cache and .pyc files so runs are comparable
+    timings = [run_once(env) for _ in range(args.runs)]
+
+    results = {
+        'runs': args.runs,
+        'median_ms': statistics.median(timings) * 1000,
+        'min_ms': min(timings) * 1000,
+        'max_ms': max(timings) * 1000,
+        'slowest_imports': slowest_imports(env),
+    }
+    print(json.dumps(results, indent=2))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        limit = baseline['median_ms'] * (1 + args.tolerance)
+        if results['median_ms'] > limit:
+            print(f"Startup regressed: median {results['median_ms']:.1f} ms > {limit:.1f} ms allowed", file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
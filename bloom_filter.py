@@ -0,0 +1,219 @@
+"""Bloom filter of known users, so /check-user can turn away unknown ones.
+
+A definite miss answers "no such user" without a query; only possible hits
+go on to the database. Each worker builds its filter from `users` on first
+use. New users are added by /complete-profile (locally, and in the other
+workers through the cache bus). The filter is rebuilt every
+BLOOM_REBUILD_INTERVAL seconds, or when it fills past its capacity, to
+keep the false-positive rate near BLOOM_ERROR_RATE.
+
+Users created outside this app (or before a cache bus message arrives)
+aren't in the filter. So a miss is trusted only while a cheap checksum of
+`users`, probed at most every BLOOM_VERSION_CHECK_INTERVAL seconds, still
+matches the one the filter expects; when it doesn't, the filter is rebuilt
+before answering. The expected checksum starts as the one read at build
+time and takes in every row added through add(), so the app's own
+sign-ups don't force rebuilds.
+"""
+import hashlib
+import json
+import math
+import os
+import threading
+import time
+import zlib
+
+from collation import fold
+
+BLOOM_ERROR_RATE = float(os.getenv('BLOOM_ERROR_RATE', 0.01))
+BLOOM_MIN_CAPACITY = int(os.getenv('BLOOM_MIN_CAPACITY', 10000))
+BLOOM_REBUILD_INTERVAL = int(os.getenv('BLOOM_REBUILD_INTERVAL', 600))
+BLOOM_VERSION_CHECK_INTERVAL = float(os.getenv('BLOOM_VERSION_CHECK_INTERVAL', 5))  # Seconds between version probes
+
+# One row back from the server; changes whenever a user is added or removed,
+# or a userId or email changes
+VERSION_QUERY = "SELECT COUNT(*), BIT_XOR(CRC32(CONCAT_WS('|', userId, email))) FROM users"
+
+
+def user_key(user_id, email):
+    """A new users row as KnownUsers.add() and the cache bus take it."""
+    return json.dumps([user_id, email])
+
+
+def _row_checksum(user_id, email):
+    # CRC32(CONCAT_WS('|', userId, email)) for one row, as MySQL computes it
+    return zlib.crc32('|'.join(str(value) for value in (user_id, email) if value is not None).encode('utf-8'))
+
+
+class BloomFilter(object):
+
+    def __init__(self, capacity, error_rate=BLOOM_ERROR_RATE):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size_bits = max(8, int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        self.hash_count = max(1, int(round(self.size_bits / capacity * math.log(2))))
+        self.bits = bytearray((self.size_bits + 7) // 8)
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def _positions(self, key):
+        # Double hashing: k positions from two 64-bit halves of one digest
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size_bits for i in range(self.hash_count)]
+
+    def add(self, key):
+        positions = self._positions(key)
+        with self._lock:  # |= on a shared byte isn't atomic across threads
+            for position in positions:
+                self.bits[position >> 3] |= 1 << (position & 7)
+            self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+    def expected_false_positive_rate(self):
+        return (1 - math.exp(-self.hash_count * self.count / self.size_bits)) ** self.hash_count
+
+
+class KnownUsers(object):
+    """Per-worker filter over users' userIds and emails."""
+
+    def __init__(self, error_rate=BLOOM_ERROR_RATE, min_capacity=BLOOM_MIN_CAPACITY,
+                 rebuild_interval=BLOOM_REBUILD_INTERVAL, check_interval=BLOOM_VERSION_CHECK_INTERVAL):
+        self.error_rate = error_rate
+        self.min_capacity = min_capacity
+        self.rebuild_interval = rebuild_interval
+        self.check_interval = check_interval
+        self._filter = None
+        self._built_at = 0
+        self._version = None  # VERSION_QUERY's row when the filter was built, plus rows added since
+        self._checked_at = 0
+        self._lock = threading.Lock()  # Held for a whole rebuild
+        self._version_lock = threading.Lock()
+        self._pending = None  # Keys added while a rebuild is reading `users`
+        self.definite_misses = 0
+        self.possible_hits = 0
+        self.false_positives = 0
+
+    def _build(self, connect):
+        self._pending = []
+        cursor = connect().cursor()
+        try:
+            # Read before the users, so a user added mid-build shows up as a change
+            cursor.execute(VERSION_QUERY)
+            version = tuple(cursor.fetchone())
+            total = version[0]
+            # Room to grow, so new sign-ups don't force a rebuild straight away
+            bloom = BloomFilter(max(self.min_capacity, total * 4), self.error_rate)
+            cursor.execute("SELECT userId, email FROM users")
+            while True:
+                rows = cursor.fetchmany(1000)
+                if not rows:
+                    break
+                for user_id, email in rows:
+                    if user_id:
+                        bloom.add('id:' + fold(user_id))
+                    if email:
+                        bloom.add('email:' + fold(email))
+        finally:
+            cursor.close()
+        pending, self._pending = self._pending, None
+        for key in pending:
+            bloom.add(key)
+        with self._version_lock:
+            self._filter = bloom
+            self._version = version
+        self._built_at = self._checked_at = time.monotonic()
+
+    def _changed(self, connect):
+        # True when `users` no longer matches the filter; probed at most every check_interval
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval:
+            return False
+        self._checked_at = now
+        cursor = connect().cursor()
+        try:
+            cursor.execute(VERSION_QUERY)
+            return tuple(cursor.fetchone()) != self._version
+        finally:
+            cursor.close()
+
+    def _current(self, connect, outdated=None):
+        # `outdated` is a filter found to be stale; rebuilt unless another thread already has
+        bloom = self._filter
+        if (bloom is None or bloom is outdated or bloom.count > bloom.capacity
+                or time.monotonic() - self._built_at > self.rebuild_interval):
+            with self._lock:
+                bloom = self._filter
+                if (bloom is None or bloom is outdated or bloom.count > bloom.capacity
+                        or time.monotonic() - self._built_at > self.rebuild_interval):
+                    try:
+                        self._build(connect)
+                    finally:
+                        self._pending = None
+                    bloom = self._filter
+        return bloom
+
+    def might_exist(self, connect, user_id=None, email=None):
+        """False only when the user definitely does not exist."""
+        value = user_id or email
+        if not isinstance(value, str):
+            return True  # Not a key the filter holds; let the database decide
+        key = ('id:' if user_id else 'email:') + fold(value)
+        bloom = self._current(connect)
+        if key not in bloom and self._changed(connect):
+            bloom = self._current(connect, outdated=bloom)
+        if key in bloom:
+            self.possible_hits += 1
+            return True
+        self.definite_misses += 1
+        return False
+
+    def record_miss(self, user_id=None, email=None):
+        # A possible hit that the database didn't find; identifiers might_exist()
+        # passed straight through never went near the filter
+        if isinstance(user_id or email, str):
+            self.false_positives += 1
+
+    def add(self, key):
+        """Take in a users row just inserted; `key` is user_key(), as the cache bus carries it."""
+        try:
+            user_id, email = json.loads(key)
+        except (ValueError, TypeError):
+            return
+        keys = [kind + fold(value) for kind, value in (('id:', user_id), ('email:', email))
+                if value and isinstance(value, str)]
+        pending = self._pending
+        if pending is not None:
+            pending.extend(keys)
+        bloom = self._filter
+        if bloom is not None:
+            for filter_key in keys:
+                bloom.add(filter_key)
+        with self._version_lock:
+            version = self._version
+            if version is not None and bloom is self._filter:
+                # What VERSION_QUERY now returns, if no one else has touched `users`
+                self._version = (version[0] + 1, (version[1] or 0) ^ _row_checksum(user_id, email))
+
+    def reset(self):
+        self._filter = None  # Rebuilt on next use
+
+    def stats(self):
+        bloom = self._filter
+        negatives = self.false_positives + self.definite_misses
+        return {
+            'built': bloom is not None,
+            'items': bloom.count if bloom else 0,
+            'capacity': bloom.capacity if bloom else 0,
+            'size_bytes': len(bloom.bits) if bloom else 0,
+            'hash_count': bloom.hash_count if bloom else 0,
+            'expected_false_positive_rate': bloom.expected_false_positive_rate() if bloom else 0.0,
+            'measured_false_positive_rate': self.false_positives / negatives if negatives else 0.0,
+            'definite_misses': self.definite_misses,
+            'possible_hits': self.possible_hits,
+            'false_positives': self.false_positives,
+        }
@@ -0,0 +1,155 @@
+"""In-process inverted index over the catalog, for /search?q=.
+
+Title, code, department and category are split into lower-cased word
+tokens. Every query term of at least SEARCH_MIN_PREFIX characters matches
+as a prefix ("calc" finds "Calculus"), so the endpoint works for
+typeahead; shorter terms only match a whole word, since a one-letter
+prefix spans a large part of the index. A book must match all terms. Hits
+are ranked by how many terms matched a whole word, then by rating, then
+by views.
+
+The index follows the catalog snapshot. When a new snapshot is loaded,
+only the books that were added, removed or changed are re-indexed, and
+the sorted token list is rebuilt once at the end.
+"""
+import bisect
+import heapq
+import os
+import re
+import threading
+from collections import Counter
+
+SEARCH_FIELDS = ('title', 'code', 'department', 'category')
+SEARCH_LIMIT = 20
+SEARCH_LIMIT_MAX = 100
+SEARCH_MIN_PREFIX = int(os.getenv('SEARCH_MIN_PREFIX', 2))  # Shorter terms match whole words only
+
+_TOKEN = re.compile(r'\w+')
+
+
+def tokenize(text):
+    return _TOKEN.findall(text.casefold()) if isinstance(text, str) else []
+
+
+class SearchIndex(object):
+
+    def __init__(self):
+        self._snapshot = None
+        self._rows = {}  # Book id -> row it was indexed from
+        self._tokens_by_id = {}  # Book id -> its tokens
+        self._postings = {}  # Token -> set of book ids
+        self._sorted_tokens = []  # Every token, sorted, for prefix ranges
+        self._new_tokens = []  # Tokens to add to _sorted_tokens at the end of a sync
+        self._removed_tokens = set()  # And tokens to take out of it
+        self._popularity = {}  # Book id -> sort key, most popular (rating, then views) first
+        self._lock = threading.Lock()
+
+    def sync(self, snapshot):
+        """Bring the index up to date with `snapshot`, re-indexing only changed books."""
+        if snapshot is self._snapshot:
+            return
+        with self._lock:
+            if snapshot is self._snapshot:
+                return
+            indexes = [snapshot.column_index[field] for field in SEARCH_FIELDS]
+            rating_col = snapshot.column_index['rating']
+            views_col = snapshot.column_index['views']
+            for book_id in set(self._rows) - set(snapshot.by_id):
+                self._remove(book_id)
+            for book_id, row in snapshot.by_id.items():
+                old = self._rows.get(book_id)
+                if old is not None and old == row:
+                    continue
+                if old is not None:
+                    self._remove(book_id)
+                self._add(book_id, row, indexes, rating_col, views_col)
+            if self._new_tokens or self._removed_tokens:
+                # Applied once per sync; keeping the list sorted token by token was quadratic on the first build
+                tokens = self._sorted_tokens
+                if len(self._removed_tokens) > len(tokens) // 100:
+                    tokens = [token for token in tokens if token not in self._removed_tokens]
+                else:
+                    for token in self._removed_tokens:
+                        del tokens[bisect.bisect_left(tokens, token)]
+                tokens.extend(self._new_tokens)
+                tokens.sort()  # Two sorted runs, which timsort merges in linear time
+                self._sorted_tokens = tokens
+                self._new_tokens = []
+                self._removed_tokens = set()
+            self._snapshot = snapshot
+
+    def _add(self, book_id, row, indexes, rating_col, views_col):
+        tokens = set()
+        for i in indexes:
+            tokens.update(tokenize(row[i]))
+        for token in tokens:
+            postings = self._postings.get(token)
+            if postings is None:
+                postings = self._postings[token] = set()
+                if token in self._removed_tokens:
+                    self._removed_tokens.discard(token)  # Dropped and re-added this sync; still listed
+                else:
+                    self._new_tokens.append(token)
+            postings.add(book_id)
+        self._rows[book_id] = row
+        self._tokens_by_id[book_id] = tokens
+        self._popularity[book_id] = (-(row[rating_col] or 0), -(row[views_col] or 0), book_id)
+
+    def _remove(self, book_id):
+        for token in self._tokens_by_id.pop(book_id, ()):
+            postings = self._postings[token]
+            postings.discard(book_id)
+            if not postings:
+                del self._postings[token]
+                self._removed_tokens.add(token)
+        self._rows.pop(book_id, None)
+        self._popularity.pop(book_id, None)
+
+    def _prefix_matches(self, term, candidates=None):
+        # Book ids with a token starting with `term` (equal to it, if it is short),
+        # out of `candidates` if given
+        if len(term) < SEARCH_MIN_PREFIX:
+            found = self._postings.get(term, set())
+            return found if candidates is None else candidates & found
+        tokens = self._sorted_tokens
+        start = bisect.bisect_left(tokens, term)
+        end = bisect.bisect_left(tokens, term + '\U0010ffff', start)  # Past the last token with this prefix
+        if candidates is not None and len(candidates) < end - start:
+            # Fewer books left than tokens to merge: check each book's own tokens instead
+            tokens_by_id = self._tokens_by_id
+            return set(book_id for book_id in candidates
+                       if any(token.startswith(term) for token in tokens_by_id[book_id]))
+        postings = self._postings
+        found = set().union(*[postings[token] for token in tokens[start:end]])
+        return found if candidates is None else candidates & found
+
+    def search(self, query, limit=SEARCH_LIMIT):
+        """Return (rows, total) for the best `limit` books matching every term of `query`."""
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms:
+            return [], 0
+        with self._lock:
+            matches = None
+            for term in sorted(terms, key=len, reverse=True):  # Longest (most selective) first
+                matches = self._prefix_matches(term, matches)
+                if not matches:
+                    return [], 0
+            # Ranked by how many terms are whole words of the book, then by
+            # popularity. Grouping by the first means the (often large) set of
+            # prefix-only matches is cut down by one key lookup per book.
+            whole_words = Counter()
+            for term in terms:
+                exact = self._postings.get(term)
+                if exact:
+                    whole_words.update(exact & matches)
+            tiers = {}
+            for book_id, count in whole_words.items():
+                tiers.setdefault(count, []).append(book_id)
+            best = []
+            for count in sorted(tiers, reverse=True) + [0]:
+                tier = tiers[count] if count else matches.difference(whole_words)
+                best.extend(heapq.nsmallest(limit - len(best), tier, key=self._popularity.__getitem__))
+                if len(best) >= limit:
+                    break
+            rows = self._rows
+            return [rows[book_id] for book_id in best], len(matches)
@@ -0,0 +1,127 @@
+"""Cross-worker invalidation for the in-process caches.
+
+Each gunicorn worker keeps its own caches, so a write handled by one
+worker has to reach the others. publish() appends a `namespace<TAB>key`
+line to a journal file shared by every worker on the host. poll() (once
+per request, a single stat() when nothing changed) reads new lines and
+calls the handler subscribed for each namespace. Keys often come straight
+from a request (a userId, an email), so tabs, newlines and backslashes in
+them are escaped; a line that still doesn't parse is skipped.
+
+If the journal is rotated, or a worker can't keep up, subscribers are
+reset (told to drop everything) instead of missing events. Caches keep
+their own TTLs as a backstop, e.g. for deployments spread across hosts.
+"""
+import os
+import re
+import tempfile
+import threading
+
+CACHE_BUS_PATH = os.getenv('CACHE_BUS_PATH', os.path.join(tempfile.gettempdir(), 'unibooks-cache-bus.log'))
+CACHE_BUS_MAX_BYTES = int(os.getenv('CACHE_BUS_MAX_BYTES', 1024 * 1024))  # Journal is rotated past this size
+
+_ESCAPES = {'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'}
+_UNESCAPES = {'t': '\t', 'n': '\n', 'r': '\r'}
+_SPECIAL = re.compile(r'[\\\t\n\r]')
+_ESCAPED = re.compile(r'\\(.)')
+
+
+def _escape(key):
+    return _SPECIAL.sub(lambda match: _ESCAPES[match.group()], str(key))
+
+
+def _unescape(key):
+    return _ESCAPED.sub(lambda match: _UNESCAPES.get(match.group(1), match.group(1)), key)
+
+
+class CacheBus(object):
+
+    def __init__(self, path=CACHE_BUS_PATH, max_bytes=CACHE_BUS_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._handlers = {}  # namespace -> (on_key, on_reset)
+        self._lock = threading.Lock()
+        self._inode = None
+        self._offset = 0
+        self._seek_to_end()
+
+    def _seek_to_end(self):
+        # Events published before this worker started concern caches it doesn't have yet
+        try:
+            stat = os.stat(self.path)
+            self._inode, self._offset = stat.st_ino, stat.st_size
+        except FileNotFoundError:
+            self._inode, self._offset = None, 0
+
+    def subscribe(self, namespace, on_key, on_reset):
+        self._handlers[namespace] = (on_key, on_reset)
+
+    def publish(self, namespace, *keys):
+        if _SPECIAL.search(namespace):
+            raise ValueError(f"Invalid cache bus namespace: {namespace!r}")
+        lines = ''.join(f"{namespace}\t{_escape(key)}\n" for key in keys if key is not None)
+        if not lines:
+            return
+        # O_APPEND writes this small land whole, even with several workers appending
+        data = lines.encode('utf-8')
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, data)
+            end = os.lseek(fd, 0, os.SEEK_CUR)  # Just past our own lines
+            stat = os.fstat(fd)
+        finally:
+            os.close(fd)
+        with self._lock:
+            # This worker has already applied its own change; skip reading it back
+            # if nothing else is waiting in front of it
+            if stat.st_ino == self._inode and self._offset == end - len(data):
+                self._offset = end
+            elif self._inode is None and end == len(data):
+                self._inode, self._offset = stat.st_ino, end
+        size = stat.st_size
+        if size > self.max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        # Swap in an empty journal; readers notice the new inode and reset
+        fd, fresh = tempfile.mkstemp(dir=os.path.dirname(self.path))
+        os.close(fd)
+        os.chmod(fresh, 0o644)
+        os.replace(fresh, self.path)
+
+    def poll(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        if stat.st_ino == self._inode and stat.st_size == self._offset:
+            return
+
+        with self._lock:
+            if stat.st_ino != self._inode or stat.st_size < self._offset:
+                self._reset_all()
+                self._inode, self._offset = stat.st_ino, 0
+            if stat.st_size - self._offset > self.max_bytes:
+                # Too far behind to be worth replaying
+                self._reset_all()
+                self._offset = stat.st_size
+                return
+
+            with open(self.path, 'rb') as f:
+                f.seek(self._offset)
+                data = f.read(stat.st_size - self._offset)
+            end = data.rfind(b'\n') + 1  # Leave a partially written line for next time
+            self._offset += end
+
+            # Only \n ends a line; splitlines() would also split on \x0b, \x1c, \u2028 and the like
+            for line in data[:end].decode('utf-8', 'replace').split('\n'):
+                if line.count('\t') != 1:
+                    continue  # Blank, or not written by publish()
+                namespace, _, key = line.partition('\t')
+                handler = self._handlers.get(namespace)
+                if handler is not None:
+                    handler[0](_unescape(key))
+
+    def _reset_all(self):
+        for _, on_reset in self._handlers.values():
+            on_reset()
@@ -0,0 +1,213 @@
+"""In-process snapshot of the `books` catalog.
+
+The snapshot is loaded once per worker and every /findbooks facet is built
+from it in memory. It is reloaded when the TTL runs out, or earlier when the
+cheap version probe reports that the catalog changed.
+"""
+import bisect
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from collation import fold
+
+CATALOG_CACHE_TTL = int(os.getenv('CATALOG_CACHE_TTL', 300))  # Seconds before a forced reload
+CATALOG_VERSION_CHECK_INTERVAL = int(os.getenv('CATALOG_VERSION_CHECK_INTERVAL', 15))  # Seconds between version probes
+
+SCIENCE_DEPARTMENTS = ('Physics and Astronomy', 'Pure and Industrial Chemistry', 'Micro Biology')
+ON_SALE_PRICE = 2000
+
+BOOKS_PAGE_SIZE = int(os.getenv('BOOKS_PAGE_SIZE', 50))  # Default ?limit= for paginated listings
+BOOKS_PAGE_MAX = int(os.getenv('BOOKS_PAGE_MAX', 500))
+CATALOG_PAYLOAD_CACHE_SIZE = int(os.getenv('CATALOG_PAYLOAD_CACHE_SIZE', 64))  # Serialized bodies kept per snapshot
+
+# Facets that grow with the catalog. They are ordered by id, so a paginated
+# listing pages each of them by keyset; the others are a fixed top-N.
+PAGED_FACETS = ('allBooks', 'onSaleBooks', 'engineeringBooks', 'scienceBooks', 'artsBooks', 'itBooks', 'featuredBooks')
+
+# One row back from the server; changes whenever a book is added or removed, or
+# any column the listings serve, filter, sort or search on changes. Each row's
+# checksum includes its id, so edits to different books can't cancel out.
+VERSION_QUERY = ("SELECT COUNT(*), MAX(id), BIT_XOR(CRC32(CONCAT_WS('|', id, code, title, department, price, "
+                 "available, level, rating, category, views))) FROM books")
+
+
+def make_payload(body):
+    # Strong validator over the serialized bytes
+    return body, hashlib.sha1(body).hexdigest()
+
+
+def _top(rows, index, limit):
+    # ORDER BY <col> DESC puts NULLs last
+    return sorted(rows, key=lambda row: (row[index] is not None, row[index] or 0), reverse=True)[:limit]
+
+
+class CatalogSnapshot(object):
+
+    def __init__(self, columns, rows, version):
+        self.columns = columns
+        self.rows = rows  # Ordered by id
+        self.version = version
+        self.loaded_at = time.monotonic()
+        self._payloads = OrderedDict()  # Least recently used first
+        self._payloads_lock = threading.Lock()
+
+        self.column_index = {name.lower(): i for i, name in enumerate(columns)}
+        id_col = self.column_index['id']
+        department_col = self.column_index['department']
+        rating_col = self.column_index['rating']
+        views_col = self.column_index['views']
+        price_col = self.column_index['price']
+
+        self.id_col = id_col
+        self.ids = [row[id_col] for row in rows]
+        self.by_id = dict(zip(self.ids, rows))
+        self.by_department = {}
+        self.department_ids = {}
+        for row in rows:
+            department = fold(row[department_col])
+            self.by_department.setdefault(department, []).append(row)
+            self.department_ids.setdefault(department, []).append(row[id_col])
+
+        newest_first = sorted(rows, key=lambda row: row[id_col], reverse=True)
+        most_viewed = _top(rows, views_col, 3)
+        science = set(fold(name) for name in SCIENCE_DEPARTMENTS)
+
+        self.facets = {
+            'allBooks': rows,
+            'recentChoices': newest_first[:10],
+            'newArrivals': newest_first[:3],
+            'topRatedBooks': _top(rows, rating_col, 10),
+            'onSaleBooks': [row for row in rows if row[price_col] is not None and row[price_col] < ON_SALE_PRICE],
+            'engineeringBooks': self.department_books('Engineering'),
+            'scienceBooks': [row for row in rows if fold(row[department_col]) in science],
+            'artsBooks': self.department_books('art'),
+            'itBooks': self.department_books('it'),
+            'featuredBooks': self.department_books('geology'),
+            'mostViewedBooks': most_viewed,
+            'popularBooks': most_viewed,
+        }
+        self.facet_ids = {name: [row[id_col] for row in self.facets[name]] for name in PAGED_FACETS}
+
+    def department_books(self, department):
+        return self.by_department.get(fold(department), [])
+
+    def books(self, ids):
+        # Rows for these ids, in the order given; ids of deleted books are skipped like a JOIN would
+        by_id = self.by_id
+        return [by_id[book_id] for book_id in ids if book_id in by_id]
+
+    def payload(self, key, serialize):
+        """Return (body, etag) for a response built from this snapshot.
+
+        `serialize` runs once per key while the body stays among the
+        CATALOG_PAYLOAD_CACHE_SIZE most recently used; the etag is a strong
+        validator over the serialized bytes.
+        """
+        with self._payloads_lock:
+            cached = self._payloads.get(key)
+            if cached is not None:
+                self._payloads.move_to_end(key)
+                return cached
+        cached = make_payload(serialize())
+        with self._payloads_lock:
+            self._payloads[key] = cached
+            while len(self._payloads) > CATALOG_PAYLOAD_CACHE_SIZE:
+                self._payloads.popitem(last=False)
+        return cached
+
+    def _keyset(self, rows, ids, after, limit):
+        start = bisect.bisect_right(ids, after) if after is not None else 0
+        page = rows[start:start + limit]
+        next_cursor = page[-1][self.id_col] if page and start + limit < len(rows) else None
+        return page, next_cursor
+
+    def page(self, department=None, after=None, limit=BOOKS_PAGE_SIZE):
+        """Keyset page over all books, or one department's books, ordered by id.
+
+        Returns (rows, next_cursor) where rows have id > after and
+        next_cursor is None on the last page.
+        """
+        if department is None:
+            rows, ids = self.rows, self.ids
+        else:
+            rows = self.department_books(department)
+            ids = self.department_ids.get(fold(department), [])
+        return self._keyset(rows, ids, after, limit)
+
+    def facet_page(self, name, after=None, limit=BOOKS_PAGE_SIZE):
+        """Keyset page of one of the PAGED_FACETS; returns (rows, next_cursor) like page()."""
+        return self._keyset(self.facets[name], self.facet_ids[name], after, limit)
+
+    def projection(self, fields):
+        """Column indexes for a fields= list, or None to keep whole rows.
+
+        Columns come back in table order with repeats dropped, so every
+        spelling of the same projection shares one cached body.
+        """
+        if not fields:
+            return None
+        unknown = [field for field in fields if field.lower() not in self.column_index]
+        if unknown:
+            raise ValueError(f"Unknown field(s): {', '.join(unknown)}")
+        return tuple(sorted(set(self.column_index[field.lower()] for field in fields)))
+
+    def project(self, rows, indexes):
+        if indexes is None:
+            return rows
+        return [tuple(row[i] for i in indexes) for row in rows]
+
+
+class CatalogCache(object):
+
+    def __init__(self, ttl=CATALOG_CACHE_TTL, check_interval=CATALOG_VERSION_CHECK_INTERVAL):
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self._snapshot = None
+        self._checked_at = 0
+        self._reload = False
+        self._lock = threading.Lock()
+
+    def _is_fresh(self, snapshot, now):
+        return (snapshot is not None and not self._reload
+                and now - snapshot.loaded_at < self.ttl
+                and now - self._checked_at < self.check_interval)
+
+    def get(self, connect):
+        """Return the current snapshot, touching the database only when it is stale.
+
+        `connect` is called (at most once) to get a DB-API connection when a
+        version probe or reload is needed.
+        """
+        snapshot = self._snapshot
+        if self._is_fresh(snapshot, time.monotonic()):
+            return snapshot
+
+        with self._lock:
+            snapshot = self._snapshot
+            now = time.monotonic()
+            if self._is_fresh(snapshot, now):
+                return snapshot
+
+            cursor = connect().cursor()
+            try:
+                cursor.execute(VERSION_QUERY)
+                version = tuple(cursor.fetchone())
+                if (self._reload or snapshot is None or now - snapshot.loaded_at >= self.ttl
+                        or version != snapshot.version):
+                    cursor.execute("SELECT * FROM books ORDER BY id")
+                    columns = [column[0] for column in cursor.description]
+                    snapshot = CatalogSnapshot(columns, cursor.fetchall(), version)
+                    self._snapshot = snapshot
+                    self._reload = False
+            finally:
+                cursor.close()
+
+            self._checked_at = now
+            return snapshot
+
+    def invalidate(self):
+        # Reload on the next get() regardless of the version probe
+        self._reload = True
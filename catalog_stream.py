@@ -0,0 +1,88 @@
+"""Streaming mode for the book listings (?stream=true).
+
+Rows are read through an unbuffered server-side cursor (SSCursor) and
+written out as JSON a batch at a time from a generator, so a worker holds
+one batch of rows, never the whole `books` table, and never builds the
+whole response body. This skips the catalog snapshot entirely; use it
+where the table is too big to keep in every worker, or for a one-off
+full dump.
+
+A streamed response holds its pooled connection until the client has
+read the last byte.
+"""
+import os
+import re
+
+from MySQLdb.cursors import SSCursor
+
+from catalog_cache import SCIENCE_DEPARTMENTS, ON_SALE_PRICE
+
+STREAM_BATCH_SIZE = int(os.getenv('BOOKS_STREAM_BATCH_SIZE', 500))  # Rows per fetch, and per chunk sent
+
+# /findbooks facets, in the (sorted) key order jsonify() writes them
+FINDBOOKS_QUERIES = (
+    ('allBooks', "SELECT {} FROM books ORDER BY id", ()),
+    ('artsBooks', "SELECT {} FROM books WHERE department = %s ORDER BY id", ('art',)),
+    ('engineeringBooks', "SELECT {} FROM books WHERE department = %s ORDER BY id", ('Engineering',)),
+    ('featuredBooks', "SELECT {} FROM books WHERE department = %s ORDER BY id", ('geology',)),
+    ('itBooks', "SELECT {} FROM books WHERE department = %s ORDER BY id", ('it',)),
+    ('mostViewedBooks', "SELECT {} FROM books ORDER BY views DESC, id LIMIT 3", ()),
+    ('newArrivals', "SELECT {} FROM books ORDER BY id DESC LIMIT 3", ()),
+    ('onSaleBooks', "SELECT {} FROM books WHERE price < %s ORDER BY id", (ON_SALE_PRICE,)),
+    ('popularBooks', "SELECT {} FROM books ORDER BY views DESC, id LIMIT 3", ()),
+    ('recentChoices', "SELECT {} FROM books ORDER BY id DESC LIMIT 10", ()),
+    ('scienceBooks', "SELECT {} FROM books WHERE department IN (%s, %s, %s) ORDER BY id", SCIENCE_DEPARTMENTS),
+    ('topRatedBooks', "SELECT {} FROM books ORDER BY rating DESC, id LIMIT 10", ()),
+)
+
+
+def getbooks_queries(department):
+    return (
+        ('allBooks', "SELECT {} FROM books WHERE department = %s ORDER BY id", (department,)) if department
+        else ('allBooks', None, ()),
+        ('recentChoices', "SELECT {} FROM books ORDER BY id DESC LIMIT 10", ()),
+    )
+
+
+def select_list(connection, fields):
+    """SQL column list for a fields= list; ValueError for unknown columns."""
+    if not fields:
+        return '*'
+    cursor = connection.cursor()
+    try:
+        cursor.execute("SELECT * FROM books LIMIT 0")
+        names = [column[0] for column in cursor.description]
+    finally:
+        cursor.close()
+    positions = {name.lower(): i for i, name in enumerate(names)}
+    unknown = [field for field in fields if field.lower() not in positions or not re.match(r'^\w+$', field)]
+    if unknown:
+        raise ValueError(f"Unknown field(s): {', '.join(unknown)}")
+    # Table order without repeats, the same columns CatalogSnapshot.projection() gives
+    return ', '.join(f"`{names[i]}`" for i in sorted(set(positions[field.lower()] for field in fields)))
+
+
+def stream_listing(connection, queries, columns, dumps, batch_size=STREAM_BATCH_SIZE):
+    """Yield a JSON object {key: [rows...]} with one key per (key, query, params).
+
+    `dumps` encodes one row (the app's JSON encoder, so Decimals and dates
+    come out as they do from jsonify()). A query of None gives an empty list.
+    """
+    cursor = connection.cursor(SSCursor)
+    try:
+        for position, (key, query, params) in enumerate(queries):
+            yield ('{' if position == 0 else ',') + dumps(key) + ':['
+            if query is not None:
+                cursor.execute(query.format(columns), params)
+                first = True
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    chunk = ','.join(dumps(row) for row in rows)
+                    yield chunk if first else ',' + chunk
+                    first = False
+            yield ']'
+        yield '}\n'
+    finally:
+        cursor.close()  # Drains what is left if the client went away mid-stream
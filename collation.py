@@ -0,0 +1,12 @@
+"""Key folding for the in-process caches.
+
+MySQL's default collation compares strings case-insensitively and ignores
+trailing spaces, so 'Alice ' and 'alice' find the same row. Caches keyed by
+userId, email or department fold their keys the same way, so they agree
+with the database on what counts as the same key.
+"""
+
+
+def fold(value):
+    """`value` as MySQL compares it; anything that isn't a string is returned as is."""
+    return value.rstrip().casefold() if isinstance(value, str) else value
@@ -0,0 +1,200 @@
+"""Bounded MySQL connection pool shared by the requests of a worker.
+
+Connections are opened on demand up to MYSQL_POOL_SIZE and reused after
+that. A connection that has sat idle for MYSQL_POOL_PING_AFTER seconds is
+pinged before it is handed out, and one older than MYSQL_POOL_RECYCLE
+seconds is replaced. Every cursor opened through a checked-out connection
+is closed when the connection goes back, and any open transaction is
+rolled back, so no request sees another's uncommitted state or stale
+read view.
+
+`connect` is any callable returning a DB-API connection, so the pool can
+be pointed at a local MySQL or a stand-in. `wrap_cursor`, if given, is
+applied to every cursor handed out (used for per-request DB timings).
+"""
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+MYSQL_POOL_SIZE = int(os.getenv('MYSQL_POOL_SIZE', 5))
+MYSQL_POOL_TIMEOUT = float(os.getenv('MYSQL_POOL_TIMEOUT', 10))  # Seconds to wait for a free connection
+MYSQL_POOL_RECYCLE = int(os.getenv('MYSQL_POOL_RECYCLE', 1800))  # Seconds before a connection is replaced
+MYSQL_POOL_PING_AFTER = int(os.getenv('MYSQL_POOL_PING_AFTER', 30))  # Idle seconds before a pre-ping
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class PooledConnection(object):
+    # A checked-out connection; close() hands it back to the pool
+
+    def __init__(self, pool, raw, created_at):
+        self.pool = pool
+        self.raw = raw
+        self.created_at = created_at
+        self.cursors = []
+        self.returned = False
+
+    def cursor(self, *args, **kwargs):
+        cursor = self.raw.cursor(*args, **kwargs)
+        self.cursors.append(cursor)
+        if self.pool.wrap_cursor is not None:
+            return self.pool.wrap_cursor(cursor)
+        return cursor
+
+    def commit(self):
+        self.raw.commit()
+
+    def rollback(self):
+        self.raw.rollback()
+
+    def close(self):
+        self.pool.release(self)
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+
+class ConnectionPool(object):
+
+    def __init__(self, connect, size=MYSQL_POOL_SIZE, timeout=MYSQL_POOL_TIMEOUT,
+                 recycle=MYSQL_POOL_RECYCLE, ping_after=MYSQL_POOL_PING_AFTER, wrap_cursor=None):
+        self.connect = connect
+        self.wrap_cursor = wrap_cursor
+        self.size = size
+        self.timeout = timeout
+        self.recycle = recycle
+        self.ping_after = ping_after
+        self._cond = threading.Condition()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = deque()  # (raw, created_at, returned_at); newest on the right
+        self._open = 0
+        self.checkouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.timeouts = 0
+        self.opened = 0
+        self.recycled = 0
+        self.ping_failures = 0
+
+    def acquire(self):
+        start = time.monotonic()
+        with self._cond:
+            if self._pid != os.getpid():
+                self._reset()  # Forked: the parent's sockets are not ours to use
+            while True:
+                if self._idle:
+                    entry = self._idle.pop()  # Most recently used is the likeliest to be alive
+                    break
+                if self._open < self.size:
+                    self._open += 1
+                    entry = None
+                    break
+                remaining = self.timeout - (time.monotonic() - start)
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise PoolTimeout(f"No MySQL connection free after {self.timeout}s (pool size {self.size})")
+                self._cond.wait(remaining)
+
+            waited = time.monotonic() - start
+            self.checkouts += 1
+            self.wait_seconds += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+        try:
+            raw, created_at = self._validate(entry)
+        except Exception:
+            with self._cond:
+                self._open -= 1
+                self._cond.notify()
+            raise
+        return PooledConnection(self, raw, created_at)
+
+    def _validate(self, entry):
+        # Runs outside the lock: pinging or connecting is network I/O
+        if entry is not None:
+            raw, created_at, returned_at = entry
+            now = time.monotonic()
+            if now - created_at > self.recycle:
+                self.recycled += 1
+                self._close_quietly(raw)
+            elif now - returned_at > self.ping_after:
+                try:
+                    raw.ping()
+                    return raw, created_at
+                except Exception:
+                    self.ping_failures += 1
+                    self._close_quietly(raw)
+            else:
+                return raw, created_at
+
+        raw = self.connect()
+        self.opened += 1
+        return raw, time.monotonic()
+
+    def release(self, pooled):
+        if pooled.returned:
+            return
+        pooled.returned = True
+
+        healthy = True
+        for cursor in pooled.cursors:
+            try:
+                cursor.close()
+            except Exception:
+                pass
+        if pooled.cursors:
+            # End whatever transaction the request left open
+            try:
+                pooled.raw.rollback()
+            except Exception:
+                healthy = False
+        pooled.cursors = []
+
+        with self._cond:
+            if self._pid != os.getpid():
+                return
+            if healthy:
+                self._idle.append((pooled.raw, pooled.created_at, time.monotonic()))
+            else:
+                self._open -= 1
+            self._cond.notify()
+        if not healthy:
+            self._close_quietly(pooled.raw)
+
+    @contextmanager
+    def connection(self):
+        pooled = self.acquire()
+        try:
+            yield pooled
+        finally:
+            pooled.close()
+
+    def _close_quietly(self, raw):
+        try:
+            raw.close()
+        except Exception:
+            pass
+
+    def stats(self):
+        with self._cond:
+            idle = len(self._idle)
+            return {
+                'size': self.size,
+                'open': self._open,
+                'idle': idle,
+                'in_use': self._open - idle,
+                'checkouts': self.checkouts,
+                'wait_seconds_total': self.wait_seconds,
+                'wait_seconds_max': self.max_wait_seconds,
+                'timeouts': self.timeouts,
+                'opened': self.opened,
+                'recycled': self.recycled,
+                'ping_failures': self.ping_failures,
+            }
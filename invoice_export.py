@@ -0,0 +1,208 @@
+"""Streaming ZIP export of every invoice in a date range.
+
+Invoices are read from `purchases` in keyset batches of invoice numbers.
+Each PDF comes from the invoice store, which holds the document the customer
+was issued. One that has been evicted (or predates the store) is rebuilt
+from its purchase rows in the render pool. A rebuilt PDF is not the
+original: the name and address are the buyer's current profile, the account
+number is blank, "Checked Out On" is the purchase time and the fee is
+recomputed at 10%. So it goes under reconstructed/ in the ZIP and is never
+written back to the store. Renders run in parallel in a pool of
+INVOICE_EXPORT_PROCESSES processes started for the export (not the
+per-worker pool /purchase renders in), with a bounded number in flight,
+and the ZIP is yielded entry by entry.
+
+manifest.csv, the last entry, lists every invoice that is not the stored
+original: reconstructed ones, and ones that could not be produced at all.
+Purchases made before the invoiceNumber column existed have no number, so
+they can't be exported. The manifest reports how many fall in the range.
+"""
+import csv
+import io
+import os
+import zipfile
+from collections import deque
+from datetime import timedelta
+
+EXPORT_BATCH_SIZE = int(os.getenv('INVOICE_EXPORT_BATCH_SIZE', 50))  # Invoices read per round trip
+EXPORT_PROCESSES = int(os.getenv('INVOICE_EXPORT_PROCESSES', os.cpu_count() or 1))  # Render processes per export
+EXPORT_FEE_RATE = 0.10  # "Our Fees (10%)" line, recomputed for re-rendered invoices
+
+INVOICE_NUMBERS_QUERY = """
+    SELECT DISTINCT invoiceNumber FROM purchases
+    WHERE invoiceNumber >= %s AND invoiceNumber < %s AND invoiceNumber > %s
+    ORDER BY invoiceNumber
+    LIMIT %s
+"""
+
+UNNUMBERED_QUERY = """
+    SELECT COUNT(*) FROM purchases
+    WHERE invoiceNumber IS NULL AND datePurchased >= %s AND datePurchased < %s
+"""
+
+STORED = 'stored'
+RECONSTRUCTED = 'reconstructed'
+MISSING = 'missing'
+
+INVOICE_ROWS_QUERY = """
+    SELECT purchases.invoiceNumber, purchases.price, purchases.paymentMethod, purchases.datePurchased,
+           books.code, users.username, users.flatNo, users.street, users.city, users.state
+    FROM purchases
+    JOIN books ON books.id = purchases.bookId
+    LEFT JOIN users ON users.userId = purchases.userId
+    WHERE purchases.invoiceNumber IN ({})
+    ORDER BY purchases.invoiceNumber, purchases.purchaseId
+"""
+
+
+def invoice_number_batches(connection, start_day, end_day, batch_size=EXPORT_BATCH_SIZE):
+    # Invoice numbers embed their date, so the range is a prefix range on the indexed column
+    low = f"UNB-{start_day:%Y%m%d}-"
+    high = f"UNB-{end_day + timedelta(days=1):%Y%m%d}-"
+    after = ''
+    while True:
+        cursor = connection.cursor()
+        try:
+            cursor.execute(INVOICE_NUMBERS_QUERY, (low, high, after, batch_size))
+            numbers = [row[0] for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+        if not numbers:
+            return
+        yield numbers
+        if len(numbers) < batch_size:
+            return
+        after = numbers[-1]
+
+
+def unnumbered_purchases(connection, start_day, end_day):
+    """Purchase rows in the range saved before invoice numbers were recorded."""
+    cursor = connection.cursor()
+    try:
+        cursor.execute(UNNUMBERED_QUERY, (start_day, end_day + timedelta(days=1)))
+        return cursor.fetchone()[0]
+    finally:
+        cursor.close()
+
+
+def load_render_kwargs(connection, invoice_numbers):
+    """generate_invoice() arguments for each invoice, rebuilt from its purchase rows."""
+    cursor = connection.cursor()
+    try:
+        cursor.execute(INVOICE_ROWS_QUERY.format(', '.join(['%s'] * len(invoice_numbers))), tuple(invoice_numbers))
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
+
+    invoices = {}
+    for invoice_number, price, payment_method, date_purchased, code, username, flat_no, street, city, state in rows:
+        invoice = invoices.get(invoice_number)
+        if invoice is None:
+            invoice = invoices[invoice_number] = dict(
+                customer_name=username or '',
+                address=', '.join(part for part in (flat_no, street, city, state) if part),
+                date=str(date_purchased or '')[:10],  # YYYY-MM-DD
+                purchases=[],
+                method={'type': payment_method, 'account_name': username or '', 'account_number': '',
+                        'pay_by': str(date_purchased or ''), 'tax': 0},
+                stylish_ub_path=r"uni2.png"
+            )
+        # purchases stores one row per copy; fold repeats into a quantity
+        price = float(price)
+        for line in invoice['purchases']:
+            if line['book_code'] == code and line['unit_price'] == price:
+                line['quantity'] += 1
+                line['total_price'] += price
+                break
+        else:
+            invoice['purchases'].append({'book_code': code, 'quantity': 1, 'unit_price': price, 'total_price': price})
+        invoice['method']['tax'] = round(sum(line['total_price'] for line in invoice['purchases']) * EXPORT_FEE_RATE, 2)
+    return invoices
+
+
+def export_invoices(connection, start_day, end_day, store, jobs, window):
+    """Yield (invoice_number, pdf_bytes, status, detail) in invoice-number order.
+
+    status is STORED, RECONSTRUCTED or MISSING (pdf_bytes None, detail says
+    why). At most `window` invoices are held (rendering or rendered) at once.
+    """
+    in_flight = deque()  # (invoice_number, stored path or render future), in output order
+    for numbers in invoice_number_batches(connection, start_day, end_day):
+        paths = {invoice_number: store.get(invoice_number)[0] for invoice_number in numbers}
+        missing = [invoice_number for invoice_number in numbers if paths[invoice_number] is None]
+        render_kwargs = load_render_kwargs(connection, missing) if missing else {}
+
+        for invoice_number in numbers:
+            source = paths[invoice_number]
+            if source is None and invoice_number in render_kwargs:
+                source = jobs.render(invoice_number, **render_kwargs[invoice_number])
+            in_flight.append((invoice_number, source))
+            while len(in_flight) > window:
+                yield _result(*in_flight.popleft())
+
+    while in_flight:
+        yield _result(*in_flight.popleft())
+
+
+def _result(invoice_number, source):
+    if source is None:
+        return invoice_number, None, MISSING, 'not in the store and no purchase rows to rebuild it from'
+    if isinstance(source, str):
+        try:
+            with open(source, 'rb') as f:
+                return invoice_number, f.read(), STORED, ''
+        except FileNotFoundError:
+            return invoice_number, None, MISSING, 'evicted from the store during the export'
+    try:
+        return invoice_number, source.result(), RECONSTRUCTED, 'rebuilt from purchase rows; not the issued document'
+    except Exception as e:
+        print(f"Error generating invoice {invoice_number}: {e}")
+        return invoice_number, None, MISSING, f"rebuild failed: {e}"
+
+
+class _ZipStream(object):
+    # Write-only sink for ZipFile; zipfile copes with a stream it can't seek
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def stream_zip(invoices, unnumbered=0):
+    """Yield a ZIP archive chunk by chunk from export_invoices() entries, then manifest.csv.
+
+    `unnumbered` is the unnumbered_purchases() count for the range.
+    """
+    sink = _ZipStream()
+    manifest = io.StringIO()
+    writer = csv.writer(manifest)
+    writer.writerow(['invoice_number', 'status', 'file', 'detail'])
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for invoice_number, data, status, detail in invoices:
+            name = ''
+            if data is not None:
+                name = f"invoice{invoice_number}.pdf"
+                if status == RECONSTRUCTED:
+                    name = f"reconstructed/{name}"
+                day = invoice_number.split('-')[1]
+                info = zipfile.ZipInfo(name, date_time=(int(day[:4]), int(day[4:6]), int(day[6:]), 0, 0, 0))
+                info.compress_type = zipfile.ZIP_DEFLATED
+                archive.writestr(info, data)
+            if status != STORED:
+                writer.writerow([invoice_number, status, name, detail])
+            yield sink.drain()
+        if unnumbered:
+            writer.writerow(['', 'not exported', '', f"{unnumbered} purchase row(s) saved before invoice numbers "
+                                                      "were recorded; they have no invoice to export"])
+        archive.writestr('manifest.csv', manifest.getvalue())
+    yield sink.drain()  # Manifest and central directory
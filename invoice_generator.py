@@ -1,136 +1,281 @@
 from reportlab.lib.pagesizes import A4
 from reportlab.lib import colors
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, Image
-from reportlab.lib.styles import getSampleStyleSheet
+from reportlab.lib.utils import ImageReader
+from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, Flowable
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.units import inch
 from reportlab.lib.enums import TA_CENTER, TA_LEFT, TA_RIGHT
+from PIL import Image as PILImage
 from io import BytesIO
+import os
+import threading
 
-def generate_invoice(customer_name, address, date, method, purchases, output_filename, invoice_number, logo_path=None, stylish_ub_path=None):
-    # Create the PDF document
-    pdf = SimpleDocTemplate(output_filename, pagesize=A4)
-    elements = []
-    
-    # Sample style for text
-    styles = getSampleStyleSheet()
-    title_style = styles['Title']
-    title_style.alignment = TA_CENTER
-    title_style.fontSize = 24  # Make title font bigger
-    
-    normal_style = styles['Normal']
-    normal_style.fontSize = 10
-    
-    # Optional Logo: Stylish UB next to UNIBOOKS title
-    if stylish_ub_path:
-        ub_logo = Image(stylish_ub_path, 0.8 * inch, 0.8 * inch)
-        ub_logo.hAlign = 'CENTER'
-        elements.append(ub_logo)
-    
-    # Add Title (Unibooks Header)
-    elements.append(Spacer(1, 0.2 * inch))  # Space before title
-    elements.append(Paragraph(f"UNIBOOKS", title_style))
-    
-    # Invoice number and date on the right side
-    elements.append(Spacer(1, 0.2 * inch))
-    elements.append(Paragraph(f"Invoice #: {invoice_number}", normal_style))
-    elements.append(Paragraph(f"Date: {date}", normal_style))
-    
-    # Customer information on the left side
-    elements.append(Spacer(1, 0.2 * inch))
-    elements.append(Paragraph(f"Invoice to: {customer_name}", normal_style))
-    elements.append(Paragraph(f"{address}", normal_style))
-    
-    # Space before the table
-    elements.append(Spacer(1, 0.3 * inch))
-    
-    # Create Table Data
-    table_data = [["Book Code", "Quantity", "Unit Price", "Total"]]
-    total_amount = 0
-    
-    for purchase in purchases:
-        book_code = purchase['book_code']
-        quantity = purchase['quantity']
-        unit_price = purchase['unit_price']
-        total_price = purchase['total_price']
-        total_amount += total_price
-        
-        table_data.append([book_code, quantity, f"N{unit_price:.2f}", f"N{total_price:.2f}"])
-    
-    # Subtotal, Tax, and Total rows
-    # Subtotal, Tax, and Total rows
-    # Subtotal, Tax, and Total rows
-    table_data.append(["", "", "Subtotal", f"N{total_amount:.2f}"])
-    table_data.append(["", "", "Our Fees (10%)", f"N{method['tax']:.2f}"])
-    table_data.append(["", "", "Total", f"N{total_amount + method['tax']:.2f}"])
-
-
-    # Create Table
-    table = Table(table_data, colWidths=[1.5 * inch, 1.5 * inch, 1.5 * inch, 1.5 * inch])
-
-    # Styling the table
-    table_style = TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor("#4caf50")),  # Green header
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
-        ('ALIGN', (0, 0), (-1, 0), 'CENTER'),
-        ('GRID', (0, 0), (-1, -4), 0.5, colors.black),  # Borders for the book data only
-        ('BACKGROUND', (0, 1), (-1, -4), colors.whitesmoke),  # Data rows
-        ('TEXTCOLOR', (0, 1), (-1, -4), colors.black),
-        ('BACKGROUND', (-2, -3), (-1, -1), colors.whitesmoke),  # Highlight for Subtotal, Tax, Total
-        ('TEXTCOLOR', (-2, -3), (-1, -1), colors.black),
-        ('FONTNAME', (-2, -3), (-1, -1), 'Helvetica-Bold'),  # Bold font for Subtotal, Tax, Total
-        ('LEFTPADDING', (0, 0), (-1, -1), 12),
-        ('RIGHTPADDING', (0, 0), (-1, -1), 12),
-        ('ALIGN', (-2, -3), (-1, -1), 'RIGHT'),
-        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),  # Padding for the header row
-        ('LINEBELOW', (0, 0), (-1, -4), 0.5, colors.black),  # Borders up to book data
-        ('LINEABOVE', (-2, -3), (-1, -1), 0, colors.white),  # Remove borders for Subtotal, Tax, Total
-    ])
-
-    table.setStyle(table_style)
-
-    
-    elements.append(table)
-    
-    # Footer Section: Payment Information and Signature
-    elements.append(Spacer(1, 0.5 * inch))
-    elements.append(Paragraph(f"Payment Method: {method['type']}", normal_style))
-    elements.append(Paragraph(f"Account Name: {method['account_name']}", normal_style))
-    elements.append(Paragraph(f"Account No.: {method['account_number']}", normal_style))
-    elements.append(Paragraph(f"Checked Out On: {method['pay_by']}", normal_style))
-    
-    
-    # Signature and Thank You Message
-    elements.append(Spacer(1, 0.5 * inch))
-    elements.append(Paragraph("Authorized Signed", normal_style))
-    elements.append(Spacer(1, 0.2 * inch))
-    elements.append(Paragraph("Thank you for choosing Unibooks!", normal_style))
-    
-    # Build PDF
-    pdf.build(elements)
-
-# Example usage with logo
-purchases = [
-    {'book_code': 'STA211', 'quantity': 1, 'unit_price': 200, 'total_price': 200},
-    {'book_code': 'STA231', 'quantity': 2, 'unit_price': 150, 'total_price': 300},
-    {'book_code': 'COS201', 'quantity': 1, 'unit_price': 250, 'total_price': 250},
-]
-
-method = {
-    "type" : "Bank Transfer",
-    "account_name" : "John Doe",
-    "account_number" : "0123 4567 8901",
-    "pay_by" : "23 June 2023",
-    "tax": 75
-    }
-
-generate_invoice(
-    customer_name="John Doe",
-    address="123 Anywhere St., Any City, ST 12345",
-    date="2024-09-19",
-    purchases=purchases,
-    method=method,
-    output_filename="custom_unibooks_invoice.pdf",
-    invoice_number="52131",
-    logo_path=None,  # Set your logo path here if available
-    stylish_ub_path=r"uni2.png"  # Replace with UB logo path
-)
+LOGO_SIZE = 0.8 * inch
+LOGO_DPI = 300  # The logo is resampled once to this resolution at its printed size
+
+# Invoices with more lines than this are laid out a page at a time (see InvoiceLines)
+INVOICE_LARGE_THRESHOLD = int(os.getenv('INVOICE_LARGE_THRESHOLD', 100))
+
+COLUMN_WIDTHS = [1.5 * inch, 1.5 * inch, 1.5 * inch, 1.5 * inch]
+TABLE_HEADER = ["Book Code", "Quantity", "Unit Price", "Total"]
+HEADER_ROW_HEIGHT = 27  # 10pt text with the header's 12pt bottom padding
+ROW_HEIGHT = 18  # 10pt text with the default 3pt padding
+
+
+class PreloadedImage(Flowable):
+    # Draws an ImageReader that was decoded up front, so renders share it
+    def __init__(self, image, width, height, hAlign='CENTER'):
+        Flowable.__init__(self)
+        self.image = image
+        self.width = width
+        self.height = height
+        self.hAlign = hAlign
+
+    def wrap(self, availWidth, availHeight):
+        return self.width, self.height
+
+    def draw(self):
+        self.canv.drawImage(self.image, 0, 0, self.width, self.height, mask='auto')
+
+
+class InvoiceLines(Flowable):
+    """Line items and totals of a large invoice, laid out one page at a time.
+
+    Each page gets its own Table with the header row, built only when the
+    frame asks to split, so formatting work and memory are bounded by a
+    page of rows however long the invoice is. The Subtotal, Fees and Total
+    rows go on the last page, with at least one line item.
+    """
+
+    def __init__(self, renderer, purchases, totals, start=0):
+        Flowable.__init__(self)
+        self.renderer = renderer
+        self.purchases = purchases
+        self.totals = totals
+        self.start = start
+        self.width = sum(COLUMN_WIDTHS)
+        self.height = HEADER_ROW_HEIGHT + (len(purchases) - start + len(totals)) * ROW_HEIGHT
+        self.hAlign = 'CENTER'
+
+    def wrap(self, availWidth, availHeight):
+        return self.width, self.height
+
+    def split(self, availWidth, availHeight):
+        remaining = len(self.purchases) - self.start
+        rows = int((availHeight - HEADER_ROW_HEIGHT) // ROW_HEIGHT)
+        end = self.start + min(rows, remaining - 1)  # Rows that fit, leaving the last one to carry the totals
+        if end <= self.start:
+            return []  # Not even one row fits; move on to the next page
+        return [
+            self.renderer.lines_table(self.purchases[self.start:end]),
+            InvoiceLines(self.renderer, self.purchases, self.totals, end),
+        ]
+
+    def draw(self):
+        # Everything left fits here
+        table = self.renderer.lines_table(self.purchases[self.start:], self.totals)
+        table.wrapOn(self.canv, self.width, self.height)
+        table.drawOn(self.canv, 0, 0)
+
+
+def load_logo(path, size=LOGO_SIZE, dpi=LOGO_DPI):
+    pixels = int(round(size / inch * dpi))
+    with PILImage.open(path) as image:
+        image.load()
+        if max(image.size) > pixels:
+            image = image.resize((pixels, pixels), PILImage.LANCZOS)
+    reader = ImageReader(image)
+    reader.getRGBData()  # Decode now; the reader caches the pixel data for every render
+    return reader
+
+
+class InvoiceRenderer(object):
+    """Renders invoices with the logo, paragraph styles and table style built once.
+
+    Create one per worker and call render() for each invoice.
+    """
+
+    def __init__(self, stylish_ub_path=None):
+        styles = getSampleStyleSheet()
+        self.title_style = ParagraphStyle('InvoiceTitle', parent=styles['Title'], alignment=TA_CENTER, fontSize=24)
+        self.normal_style = ParagraphStyle('InvoiceNormal', parent=styles['Normal'], fontSize=10)
+        self.logo = load_logo(stylish_ub_path) if stylish_ub_path else None
+
+        # Styling the table
+        self.table_style = TableStyle([
+            ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor("#4caf50")),  # Green header
+            ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
+            ('ALIGN', (0, 0), (-1, 0), 'CENTER'),
+            ('GRID', (0, 0), (-1, -4), 0.5, colors.black),  # Borders for the book data only
+            ('BACKGROUND', (0, 1), (-1, -4), colors.whitesmoke),  # Data rows
+            ('TEXTCOLOR', (0, 1), (-1, -4), colors.black),
+            ('BACKGROUND', (-2, -3), (-1, -1), colors.whitesmoke),  # Highlight for Subtotal, Tax, Total
+            ('TEXTCOLOR', (-2, -3), (-1, -1), colors.black),
+            ('FONTNAME', (-2, -3), (-1, -1), 'Helvetica-Bold'),  # Bold font for Subtotal, Tax, Total
+            ('LEFTPADDING', (0, 0), (-1, -1), 12),
+            ('RIGHTPADDING', (0, 0), (-1, -1), 12),
+            ('ALIGN', (-2, -3), (-1, -1), 'RIGHT'),
+            ('BOTTOMPADDING', (0, 0), (-1, 0), 12),  # Padding for the header row
+            ('LINEBELOW', (0, 0), (-1, -4), 0.5, colors.black),  # Borders up to book data
+            ('LINEABOVE', (-2, -3), (-1, -1), 0, colors.white),  # Remove borders for Subtotal, Tax, Total
+        ])
+
+        # Same look for a page of a large invoice that has no totals rows
+        self.lines_style = TableStyle([
+            ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor("#4caf50")),
+            ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
+            ('ALIGN', (0, 0), (-1, 0), 'CENTER'),
+            ('GRID', (0, 0), (-1, -1), 0.5, colors.black),
+            ('BACKGROUND', (0, 1), (-1, -1), colors.whitesmoke),
+            ('TEXTCOLOR', (0, 1), (-1, -1), colors.black),
+            ('LEFTPADDING', (0, 0), (-1, -1), 12),
+            ('RIGHTPADDING', (0, 0), (-1, -1), 12),
+            ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+            ('LINEBELOW', (0, 0), (-1, -1), 0.5, colors.black),
+        ])
+
+    @staticmethod
+    def line_row(purchase):
+        return [purchase['book_code'], purchase['quantity'], f"N{purchase['unit_price']:.2f}",
+                f"N{purchase['total_price']:.2f}"]
+
+    @staticmethod
+    def totals_rows(total_amount, tax):
+        return [
+            ["", "", "Subtotal", f"N{total_amount:.2f}"],
+            ["", "", "Our Fees (10%)", f"N{tax:.2f}"],
+            ["", "", "Total", f"N{total_amount + tax:.2f}"],
+        ]
+
+    def lines_table(self, purchases, totals=()):
+        # One page of a large invoice; fixed row heights so InvoiceLines can count what fits
+        table_data = [TABLE_HEADER] + [self.line_row(purchase) for purchase in purchases] + list(totals)
+        table = Table(table_data, colWidths=COLUMN_WIDTHS,
+                      rowHeights=[HEADER_ROW_HEIGHT] + [ROW_HEIGHT] * (len(table_data) - 1))
+        table.setStyle(self.table_style if totals else self.lines_style)
+        return table
+
+    def render(self, customer_name, address, date, method, purchases, output_filename, invoice_number, large=None):
+        # large: lay the table out a page at a time; by default when there are over INVOICE_LARGE_THRESHOLD lines
+        if large is None:
+            large = len(purchases) > INVOICE_LARGE_THRESHOLD
+
+        # Create the PDF document
+        pdf = SimpleDocTemplate(output_filename, pagesize=A4)
+        elements = []
+        title_style = self.title_style
+        normal_style = self.normal_style
+
+        # Optional Logo: Stylish UB next to UNIBOOKS title
+        if self.logo is not None:
+            elements.append(PreloadedImage(self.logo, LOGO_SIZE, LOGO_SIZE))
+
+        # Add Title (Unibooks Header)
+        elements.append(Spacer(1, 0.2 * inch))  # Space before title
+        elements.append(Paragraph(f"UNIBOOKS", title_style))
+
+        # Invoice number and date on the right side
+        elements.append(Spacer(1, 0.2 * inch))
+        elements.append(Paragraph(f"Invoice #: {invoice_number}", normal_style))
+        elements.append(Paragraph(f"Date: {date}", normal_style))
+
+        # Customer information on the left side
+        elements.append(Spacer(1, 0.2 * inch))
+        elements.append(Paragraph(f"Invoice to: {customer_name}", normal_style))
+        elements.append(Paragraph(f"{address}", normal_style))
+
+        # Space before the table
+        elements.append(Spacer(1, 0.3 * inch))
+
+        if large:
+            purchases = list(purchases)
+            total_amount = sum(purchase['total_price'] for purchase in purchases)
+            elements.append(InvoiceLines(self, purchases, self.totals_rows(total_amount, method['tax'])))
+        else:
+            # Create Table Data
+            table_data = [TABLE_HEADER]
+            total_amount = 0
+
+            for purchase in purchases:
+                total_amount += purchase['total_price']
+                table_data.append(self.line_row(purchase))
+
+            # Subtotal, Tax, and Total rows
+            table_data.extend(self.totals_rows(total_amount, method['tax']))
+
+            # Create Table
+            table = Table(table_data, colWidths=COLUMN_WIDTHS)
+            table.setStyle(self.table_style)
+            elements.append(table)
+
+        # Footer Section: Payment Information and Signature
+        elements.append(Spacer(1, 0.5 * inch))
+        elements.append(Paragraph(f"Payment Method: {method['type']}", normal_style))
+        elements.append(Paragraph(f"Account Name: {method['account_name']}", normal_style))
+        elements.append(Paragraph(f"Account No.: {method['account_number']}", normal_style))
+        elements.append(Paragraph(f"Checked Out On: {method['pay_by']}", normal_style))
+
+        # Signature and Thank You Message
+        elements.append(Spacer(1, 0.5 * inch))
+        elements.append(Paragraph("Authorized Signed", normal_style))
+        elements.append(Spacer(1, 0.2 * inch))
+        elements.append(Paragraph("Thank you for choosing Unibooks!", normal_style))
+
+        # Build PDF
+        pdf.build(elements)
+
+
+_renderers = {}
+_renderers_lock = threading.Lock()
+
+
+def get_renderer(stylish_ub_path=None):
+    # One renderer per logo, shared by every call in this process
+    renderer = _renderers.get(stylish_ub_path)
+    if renderer is None:
+        with _renderers_lock:
+            renderer = _renderers.get(stylish_ub_path)
+            if renderer is None:
+                renderer = _renderers[stylish_ub_path] = InvoiceRenderer(stylish_ub_path)
+    return renderer
+
+
+def generate_invoice(customer_name, address, date, method, purchases, output_filename, invoice_number, logo_path=None, stylish_ub_path=None, large=None):
+    get_renderer(stylish_ub_path).render(
+        customer_name=customer_name,
+        address=address,
+        date=date,
+        method=method,
+        purchases=purchases,
+        output_filename=output_filename,
+        invoice_number=invoice_number,
+        large=large
+    )
+
+if __name__ == '__main__':
+    # Example usage with logo
+    purchases = [
+        {'book_code': 'STA211', 'quantity': 1, 'unit_price': 200, 'total_price': 200},
+        {'book_code': 'STA231', 'quantity': 2, 'unit_price': 150, 'total_price': 300},
+        {'book_code': 'COS201', 'quantity': 1, 'unit_price': 250, 'total_price': 250},
+    ]
+
+    method = {
+        "type" : "Bank Transfer",
+        "account_name" : "John Doe",
+        "account_number" : "0123 4567 8901",
+        "pay_by" : "23 June 2023",
+        "tax": 75
+        }
+
+    generate_invoice(
+        customer_name="John Doe",
+        address="123 Anywhere St., Any City, ST 12345",
+        date="2024-09-19",
+        purchases=purchases,
+        method=method,
+        output_filename="custom_unibooks_invoice.pdf",
+        invoice_number="52131",
+        logo_path=None,  # Set your logo path here if available
+        stylish_ub_path=r"uni2.png"  # Replace with UB logo path
+    )
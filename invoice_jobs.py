@@ -0,0 +1,176 @@
+"""Render invoices in a process pool instead of on the request worker.
+
+Finished PDFs go into the shared InvoiceStore. Jobs still in flight are
+tracked with marker files in INVOICE_JOB_DIR so any gunicorn worker can
+report on them: `<number>.pending` from submission until the render ends,
+and `<number>.failed` if it raised. The pending marker holds the pid of the
+worker that owns the job, and is marked started when a pool process picks
+the job up, so a job waiting in the queue is not mistaken for a hung one.
+"""
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+
+from invoice_numbers import INVOICE_NUMBER_PATTERN
+from invoice_store import InvoiceStore
+
+INVOICE_JOB_DIR = os.getenv('INVOICE_JOB_DIR', os.path.join(tempfile.gettempdir(), 'unibooks-invoices'))
+# Per gunicorn worker, so the host runs workers x this many ReportLab processes
+INVOICE_RENDER_PROCESSES = int(os.getenv('INVOICE_RENDER_PROCESSES', 1))
+INVOICE_JOB_TIMEOUT = int(os.getenv('INVOICE_JOB_TIMEOUT', 120))  # Seconds a started render may run before it counts as failed
+
+PENDING = 'pending'
+FAILED = 'failed'
+
+_store = None  # The pool process's handle on the invoice store
+
+
+def _path(invoice_number, suffix):
+    return os.path.join(INVOICE_JOB_DIR, f"{invoice_number}.{suffix}")
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _mark_failed(invoice_number):
+    with open(_path(invoice_number, 'failed'), 'w'):
+        pass
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def render_to_file(invoice_number, render_kwargs):
+    # Runs in a pool process; the PDF only becomes visible once it is in the store
+    global _store
+    from invoice_generator import generate_invoice
+
+    try:
+        # Started: the timeout counts from now, not from when the job was queued
+        with open(_path(invoice_number, 'pending'), 'a') as f:
+            f.write('started\n')
+        pdf_buffer = BytesIO()
+        generate_invoice(output_filename=pdf_buffer, invoice_number=invoice_number, **render_kwargs)
+        if _store is None:
+            _store = InvoiceStore()
+        _store.put(invoice_number, pdf_buffer.getvalue())
+    except Exception:
+        _mark_failed(invoice_number)
+        raise
+    finally:
+        _remove(_path(invoice_number, 'pending'))
+
+
+def render_to_bytes(invoice_number, render_kwargs):
+    # Runs in a pool process for bulk work. Never stored: the store only holds
+    # the PDF the customer was actually issued.
+    from invoice_generator import generate_invoice
+
+    pdf_buffer = BytesIO()
+    generate_invoice(output_filename=pdf_buffer, invoice_number=invoice_number, **render_kwargs)
+    return pdf_buffer.getvalue()
+
+
+class InvoiceJobs(object):
+
+    def __init__(self, processes=INVOICE_RENDER_PROCESSES):
+        self.processes = processes
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _executor(self, broken=None):
+        # One pool per gunicorn worker, created on first use. Spawned rather
+        # than forked so the children don't inherit the worker's threads.
+        # `broken` is a pool that refused work; replaced unless another thread already has.
+        if self._pid != os.getpid() or self._pool is broken:
+            with self._lock:
+                if self._pid != os.getpid() or self._pool is broken:
+                    if self._pool is not None and self._pid == os.getpid():
+                        self._pool.shutdown(wait=False)
+                    os.makedirs(INVOICE_JOB_DIR, exist_ok=True)
+                    self._pool = ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context('spawn'))
+                    self._pid = os.getpid()
+        return self._pool
+
+    def _submit(self, fn, *args):
+        pool = self._executor()
+        try:
+            return pool.submit(fn, *args)
+        except BrokenProcessPool:
+            # A pool process died (killed, out of memory) and the pool refuses
+            # all work from then on; start a fresh one
+            print("Invoice render pool is broken; replacing it")
+            return self._executor(broken=pool).submit(fn, *args)
+
+    def submit(self, invoice_number, **render_kwargs):
+        """Queue a render of `invoice_number`; generate_invoice() keyword arguments pass through."""
+        # Written before the job is queued, so the pool process's "started" can't come first
+        with open(_path(invoice_number, 'pending'), 'w') as f:
+            f.write(f"{os.getpid()}\n")
+        try:
+            future = self._submit(render_to_file, invoice_number, render_kwargs)
+        except Exception:
+            _remove(_path(invoice_number, 'pending'))  # Never queued, so never pending
+            raise
+
+        def report(done):
+            if done.exception() is not None:
+                print(f"Error generating invoice {invoice_number}: {done.exception()}")
+                # Also covers a pool process that died before render_to_file could say so
+                if os.path.exists(_path(invoice_number, 'pending')):
+                    _mark_failed(invoice_number)
+                    _remove(_path(invoice_number, 'pending'))
+
+        future.add_done_callback(report)
+        return future
+
+    def render(self, invoice_number, **render_kwargs):
+        """Render in the pool without job markers or storing; the future resolves to the PDF bytes."""
+        return self._submit(render_to_bytes, invoice_number, render_kwargs)
+
+    def shutdown(self):
+        # Drop queued jobs and let the pool processes exit once their current render is done
+        if self._pool is not None and self._pid == os.getpid():
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = self._pid = None
+
+    def status(self, invoice_number):
+        """Return PENDING or FAILED for a job that has not reached the store, else None."""
+        if not INVOICE_NUMBER_PATTERN.match(invoice_number):
+            return None
+        if os.path.exists(_path(invoice_number, 'failed')):
+            return FAILED
+        path = _path(invoice_number, 'pending')
+        try:
+            with open(path) as f:
+                lines = f.read().split()
+            changed = os.path.getmtime(path)
+        except FileNotFoundError:
+            return None
+        # Queued jobs die with the worker that owns the pool; started ones may hang
+        try:
+            owner = int(lines[0])
+        except (IndexError, ValueError):
+            owner = None  # Marker still being written
+        if owner is not None and not _alive(owner):
+            return FAILED
+        if 'started' in lines and time.time() - changed > INVOICE_JOB_TIMEOUT:
+            return FAILED
+        return PENDING
@@ -0,0 +1,192 @@
+"""Background delivery of invoice PDFs by email.
+
+send() only queues the message. A daemon thread per worker sends the queue
+over one Flask-Mail connection (get_mail().connect()), which stays open
+between messages and is closed after INVOICE_MAIL_IDLE_TIMEOUT idle
+seconds. A message that fails with a temporary error (connection trouble,
+a 4xx reply, or a PDF that is still rendering) is retried after
+INVOICE_MAIL_RETRY_DELAY seconds, doubling each time up to
+INVOICE_MAIL_RETRY_MAX_DELAY, for at most INVOICE_MAIL_MAX_ATTEMPTS tries.
+A 5xx refusal is dropped straight away. Whatever is still queued is sent
+when the worker exits; pending retries are not.
+
+To try it against a local sink:
+
+    python -m aiosmtpd -n -l localhost:8025
+    MAIL_SERVER=localhost MAIL_PORT=8025 MAIL_DEFAULT_SENDER=invoices@unibooks.test INVOICE_EMAIL=True ...
+"""
+import heapq
+import itertools
+import os
+import queue
+import random
+import smtplib
+import time
+
+from background_queue import BackgroundQueue, STOP
+
+INVOICE_MAIL_QUEUE_SIZE = int(os.getenv('INVOICE_MAIL_QUEUE_SIZE', 1000))
+INVOICE_MAIL_IDLE_TIMEOUT = float(os.getenv('INVOICE_MAIL_IDLE_TIMEOUT', 30))
+INVOICE_MAIL_MAX_ATTEMPTS = int(os.getenv('INVOICE_MAIL_MAX_ATTEMPTS', 5))
+INVOICE_MAIL_RETRY_DELAY = float(os.getenv('INVOICE_MAIL_RETRY_DELAY', 10))
+INVOICE_MAIL_RETRY_MAX_DELAY = float(os.getenv('INVOICE_MAIL_RETRY_MAX_DELAY', 600))
+
+
+class InvoiceNotReady(Exception):
+    pass
+
+
+class _Delivery(object):
+    __slots__ = ('recipient', 'invoice_number', 'customer_name', 'pdf', 'attempts')
+
+    def __init__(self, recipient, invoice_number, customer_name, pdf):
+        self.recipient = recipient
+        self.invoice_number = invoice_number
+        self.customer_name = customer_name
+        self.pdf = pdf
+        self.attempts = 0
+
+
+def _permanent(error):
+    # 5xx replies won't change on a retry; connection trouble and 4xx replies might
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code >= 500
+    return not isinstance(error, (InvoiceNotReady, OSError))  # smtplib's other errors are OSErrors
+
+
+class InvoiceMailer(object):
+
+    def __init__(self, app, get_mail, store, queue_size=INVOICE_MAIL_QUEUE_SIZE,
+                 idle_timeout=INVOICE_MAIL_IDLE_TIMEOUT, max_attempts=INVOICE_MAIL_MAX_ATTEMPTS,
+                 retry_delay=INVOICE_MAIL_RETRY_DELAY, retry_max_delay=INVOICE_MAIL_RETRY_MAX_DELAY):
+        self.app = app  # Flask-Mail builds and sends messages inside an app context
+        self.get_mail = get_mail
+        self.store = store  # Where PDFs rendered in the background are read from
+        self.queue_size = queue_size
+        self.idle_timeout = idle_timeout
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.retry_max_delay = retry_max_delay
+        self.sent = 0
+        self.retried = 0
+        self.dropped = 0
+        self._worker = BackgroundQueue(self._run, 'invoice-mailer', queue_size)
+
+    def send(self, recipient, invoice_number, pdf=None, customer_name=None):
+        """Queue invoice `invoice_number` for `recipient`; without `pdf` it is read from the store."""
+        q = self._worker.ensure_started()
+        try:
+            q.put_nowait(_Delivery(recipient, invoice_number, customer_name, pdf))
+        except queue.Full:
+            print(f"Invoice mail queue full; not emailing invoice {invoice_number}")
+            self.dropped += 1
+
+    def _run(self, q):
+        retries = []  # (due, sequence, delivery), soonest first
+        sequence = itertools.count()
+        connection = None
+        last_used = 0
+        while True:
+            now = time.monotonic()
+            if retries and retries[0][0] <= now:
+                item = heapq.heappop(retries)[2]
+            else:
+                wake = [retries[0][0]] if retries else []
+                if connection is not None:
+                    wake.append(last_used + self.idle_timeout)
+                try:
+                    item = q.get(timeout=max(min(wake) - now, 0) if wake else None)
+                except queue.Empty:
+                    if connection is not None and time.monotonic() - last_used >= self.idle_timeout:
+                        connection = self._close(connection)
+                    continue
+            if item is STOP:
+                break
+
+            connection, retry = self._attempt(connection, item)
+            last_used = time.monotonic()
+            if retry:
+                delay = min(self.retry_delay * 2 ** (item.attempts - 1), self.retry_max_delay)
+                delay *= random.uniform(1, 1.25)  # So the workers' retries don't line up
+                heapq.heappush(retries, (last_used + delay, next(sequence), item))
+
+        # Worker exit: one try for what is queued
+        while True:
+            try:
+                item = q.get_nowait()
+            except queue.Empty:
+                break
+            if item is not STOP:
+                connection = self._attempt(connection, item)[0]
+        if retries:
+            print(f"Not retrying {len(retries)} invoice email(s) at exit")
+            self.dropped += len(retries)
+        self._close(connection)
+
+    def _attempt(self, connection, delivery):
+        # Returns (connection to keep using, whether to retry)
+        delivery.attempts += 1
+        try:
+            if delivery.pdf is None:
+                path = self.store.get(delivery.invoice_number)[0]
+                if path is None:
+                    raise InvoiceNotReady(f"invoice {delivery.invoice_number} is not in the store yet")
+                with open(path, 'rb') as f:
+                    delivery.pdf = f.read()
+            with self.app.app_context():
+                mail = self.get_mail()  # Registers Flask-Mail on the app, which Message() looks up
+                message = self._message(delivery)
+                reused = connection is not None
+                if connection is None:
+                    connection = mail.connect()
+                    connection.__enter__()  # Connects and logs in; left open for the next message
+                try:
+                    connection.send(message)
+                except smtplib.SMTPServerDisconnected:
+                    if not reused:
+                        raise
+                    # The server dropped the connection while it sat open; reconnect once
+                    self._close(connection)
+                    connection = None
+                    connection = mail.connect()
+                    connection.__enter__()
+                    connection.send(message)
+            self.sent += 1
+            return connection, False
+        except Exception as e:
+            if not isinstance(e, InvoiceNotReady):
+                connection = self._close(connection)  # Its state is unknown after an error
+            retry = not _permanent(e) and delivery.attempts < self.max_attempts
+            print(f"Error emailing invoice {delivery.invoice_number} (attempt {delivery.attempts}): {e}"
+                  + ('' if retry else '; giving up'))
+            if retry:
+                self.retried += 1
+            else:
+                self.dropped += 1
+            return connection, retry
+
+    def _message(self, delivery):
+        from flask_mail import Message
+
+        greeting = f"Dear {delivery.customer_name}," if delivery.customer_name else "Hello,"
+        message = Message(
+            subject=f"Your Unibooks invoice {delivery.invoice_number}",
+            recipients=[delivery.recipient],
+            body=f"{greeting}\n\nThank you for your purchase. Your invoice {delivery.invoice_number} is attached.\n\nUnibooks",
+        )
+        message.attach(f"invoice{delivery.invoice_number}.pdf", 'application/pdf', delivery.pdf)
+        return message
+
+    def _close(self, connection):
+        if connection is not None:
+            try:
+                connection.__exit__(None, None, None)
+            except Exception:
+                pass  # Already gone; nothing to say goodbye to
+        return None
+
+    def close(self, timeout=5):
+        # Send what is queued and stop the thread; called at worker exit
+        self._worker.close(timeout)
@@ -0,0 +1,103 @@
+"""Hi/lo allocator for UNB-YYYYMMDD-XXXX invoice numbers.
+
+Each worker atomically reserves a block of counters for the day from
+`invoice_numbers` and hands numbers out of it from memory, so only one
+purchase in every INVOICE_BLOCK_SIZE goes to the database. Blocks never
+overlap, which keeps numbers unique across gunicorn workers; numbers left
+in a block when a worker exits or the day rolls over are simply skipped.
+Numbers whose purchase fails are given back with release() and reused.
+
+Expects one row per day, keyed on `date`. Without that key ON DUPLICATE KEY
+never fires and every worker would reserve the same block, so the first
+reservation checks for it and refuses to hand out numbers if it is missing:
+
+CREATE TABLE invoice_numbers (
+    date DATE PRIMARY KEY,          -- Day the counter belongs to
+    last_counter INT NOT NULL       -- Highest counter reserved so far for that day
+);
+
+-- Existing databases (the old SELECT-then-UPDATE allocator didn't need the
+-- key; keep only the highest counter of any day that has several rows first):
+DELETE older FROM invoice_numbers older JOIN invoice_numbers newer
+    ON older.date = newer.date AND older.last_counter < newer.last_counter;
+ALTER TABLE invoice_numbers ADD PRIMARY KEY (date);
+"""
+import os
+import re
+import threading
+from datetime import datetime
+
+INVOICE_BLOCK_SIZE = int(os.getenv('INVOICE_BLOCK_SIZE', 20))
+
+INVOICE_NUMBER_PATTERN = re.compile(r'^UNB-\d{8}-\d{4,}$')
+
+# Creates or bumps today's row in one statement; LAST_INSERT_ID(expr) hands
+# the new high-water mark back to this connection without another read.
+RESERVE_QUERY = """
+    INSERT INTO invoice_numbers (date, last_counter) VALUES (%s, LAST_INSERT_ID(%s))
+    ON DUPLICATE KEY UPDATE last_counter = LAST_INSERT_ID(last_counter + %s)
+"""
+
+# Unique indexes on `date` alone; RESERVE_QUERY is only safe with one
+KEY_QUERY = """
+    SELECT INDEX_NAME FROM information_schema.STATISTICS
+    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'invoice_numbers' AND NON_UNIQUE = 0
+    GROUP BY INDEX_NAME HAVING COUNT(*) = 1 AND MAX(COLUMN_NAME) = 'date'
+"""
+
+
+class InvoiceNumberAllocator(object):
+
+    def __init__(self, block_size=INVOICE_BLOCK_SIZE):
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._day = None
+        self._next = 1  # Next counter to hand out
+        self._high = 0  # Last counter in the reserved block
+        self._released = []  # Counters handed back by failed purchases
+        self._key_checked = False
+
+    def next_number(self, connection):
+        now = datetime.now()
+        day = now.strftime('%Y-%m-%d')
+
+        with self._lock:
+            if day != self._day:
+                self._released = []
+            if self._released:
+                counter = self._released.pop()
+            else:
+                if day != self._day or self._next > self._high:
+                    self._reserve(connection, day)
+                counter = self._next
+                self._next += 1
+
+        # Format the invoice number (UNB-YYYYMMDD-XXXX)
+        return f"UNB-{now.strftime('%Y%m%d')}-{counter:04d}"
+
+    def release(self, invoice_number):
+        # The purchase behind this number was rolled back; hand it out again
+        _, day, counter = invoice_number.split('-')
+        with self._lock:
+            if self._day is not None and day == self._day.replace('-', ''):
+                self._released.append(int(counter))
+
+    def _reserve(self, connection, day):
+        cursor = connection.cursor()
+        try:
+            if not self._key_checked:
+                cursor.execute(KEY_QUERY)
+                if cursor.fetchone() is None:
+                    raise RuntimeError("invoice_numbers.date is not a PRIMARY or UNIQUE key; invoice numbers "
+                                       "would repeat across workers. Apply the migration in invoice_numbers.py.")
+                self._key_checked = True
+            cursor.execute(RESERVE_QUERY, (day, self.block_size, self.block_size))
+            cursor.execute("SELECT LAST_INSERT_ID()")
+            high = cursor.fetchone()[0]
+            connection.commit()
+        finally:
+            cursor.close()
+
+        self._day = day
+        self._high = high
+        self._next = high - self.block_size + 1
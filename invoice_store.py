@@ -0,0 +1,137 @@
+"""Local disk store for rendered invoice PDFs.
+
+PDFs are content-addressed (`objects/<sha256>.pdf`) and each invoice number
+points at its object through `numbers/<invoice number>`. Reads touch the
+object's mtime, and once the store outgrows INVOICE_STORE_MAX_BYTES the
+least recently used objects are deleted, along with the numbers that
+pointed at them. Every gunicorn worker (and the render pool) shares the
+same directory.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+
+from invoice_numbers import INVOICE_NUMBER_PATTERN
+
+INVOICE_STORE_DIR = os.getenv('INVOICE_STORE_DIR', os.path.join(tempfile.gettempdir(), 'unibooks-invoice-store'))
+INVOICE_STORE_MAX_BYTES = int(os.getenv('INVOICE_STORE_MAX_BYTES', 512 * 1024 * 1024))
+EVICT_TO = 0.9  # Eviction frees space down to this fraction of the limit
+
+
+def _write_atomic(path, data):
+    fd, partial = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(partial, path)
+    except Exception:
+        os.remove(partial)
+        raise
+
+
+class InvoiceStore(object):
+
+    def __init__(self, root=INVOICE_STORE_DIR, max_bytes=INVOICE_STORE_MAX_BYTES):
+        self.objects_dir = os.path.join(root, 'objects')
+        self.numbers_dir = os.path.join(root, 'numbers')
+        self.max_bytes = max_bytes
+        self._size = None  # This process's running estimate; rescanned before evicting
+        self._lock = threading.Lock()
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.numbers_dir, exist_ok=True)
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects_dir, f"{digest}.pdf")
+
+    def _number_path(self, invoice_number):
+        if not INVOICE_NUMBER_PATTERN.match(invoice_number):
+            raise ValueError(f"Invalid invoice number: {invoice_number}")
+        return os.path.join(self.numbers_dir, invoice_number)
+
+    def put(self, invoice_number, data):
+        """Store the PDF bytes for `invoice_number` and return their sha256."""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._object_path(digest)
+        try:
+            os.utime(path)  # Already stored (the same PDF again); mark it as recently used
+        except FileNotFoundError:
+            # New, or evicted by another worker since it was last seen
+            _write_atomic(path, data)
+            self._grew(len(data))
+        _write_atomic(self._number_path(invoice_number), digest.encode())
+        return digest
+
+    def get(self, invoice_number):
+        """Return (path, sha256) of the stored PDF, or (None, None)."""
+        try:
+            number_path = self._number_path(invoice_number)
+            with open(number_path) as f:
+                digest = f.read().strip()
+        except (ValueError, FileNotFoundError):
+            return None, None
+
+        path = self._object_path(digest)
+        try:
+            os.utime(path)  # Mark as recently used
+        except FileNotFoundError:
+            # The object was evicted; drop the dangling pointer
+            try:
+                os.remove(number_path)
+            except FileNotFoundError:
+                pass
+            return None, None
+        return path, digest
+
+    def _grew(self, added):
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan()[1]
+            else:
+                self._size += added
+            if self._size > self.max_bytes:
+                self._size = self._evict()
+
+    def _scan(self):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.objects_dir):
+            if not entry.name.endswith('.pdf'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+        return entries, total
+
+    def _evict(self):
+        # Other workers write here too, so work from the directory rather than the estimate
+        entries, total = self._scan()
+        if total <= self.max_bytes:
+            return total
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes * EVICT_TO:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                pass
+        self._drop_dangling()
+        return total
+
+    def _drop_dangling(self):
+        # Numbers whose object is gone; get() would drop each on its next
+        # lookup, but most evicted invoices are never asked for again
+        for entry in os.scandir(self.numbers_dir):
+            if entry.name.endswith('.part'):
+                continue
+            try:
+                with open(entry.path) as f:
+                    digest = f.read().strip()
+                if not os.path.exists(self._object_path(digest)):
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
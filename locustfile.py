@@ -1,14 +1,34 @@
 from locust import HttpUser, TaskSet, task, between
+import os
 import random
 from datetime import datetime
 
+# Where and what to test; benchmarks/loadtest.py points these at the database it seeds
+LOAD_TEST_HOST = os.getenv('LOAD_TEST_HOST', 'http://127.0.0.1:5000')
+
+
+def id_range(value):
+    # "first-last", inclusive
+    first, last = value.split('-')
+    return int(first), int(last)
+
+
+BOOK_IDS = id_range(os.getenv('LOAD_TEST_BOOK_IDS', '1-100'))
+USER_IDS = id_range(os.getenv('LOAD_TEST_USER_IDS', '1000-9999'))
+WAIT_TIME = tuple(float(seconds) for seconds in os.getenv('LOAD_TEST_WAIT', '1,5').split(','))
+
+
+def random_book_id():
+    return random.randint(*BOOK_IDS)
+
+
 class UserBehavior(TaskSet):
     def on_start(self):
         """
         Called when a simulated user starts.
         We'll simulate user login here and store the user_id for subsequent requests.
         """
-        self.user_id = f"user_{random.randint(1000, 9999)}"
+        self.user_id = f"user_{random.randint(*USER_IDS)}"
         self.email = f"{self.user_id}@example.com"
         self.login()
 
@@ -54,7 +74,7 @@ class UserBehavior(TaskSet):
     def get_books(self):
         # Fetch books relevant to the user
         params = {'userId': self.user_id}
-        self.client.get("/getbooks", params=params)
+        self.client.get("/getbooks", params=params, name="/getbooks")
 
     @task(2)
     def find_books(self):
@@ -66,7 +86,7 @@ class UserBehavior(TaskSet):
         # Add a random book to the wishlist
         data = {
             'userId': self.user_id,
-            'bookId': random.randint(1, 100)  # Assuming book IDs range from 1 to 100
+            'bookId': random_book_id()
         }
         self.client.post("/addToWishlist", json=data)
 
@@ -74,16 +94,16 @@ class UserBehavior(TaskSet):
     def get_wishlist(self):
         # Retrieve the user's wishlist
         params = {'userId': self.user_id}
-        self.client.get("/getWishlist", params=params)
+        self.client.get("/getWishlist", params=params, name="/getWishlist")
 
     @task(1)
     def remove_from_wishlist(self):
         # Remove a random book from the wishlist
         params = {
             'userId': self.user_id,
-            'bookId': random.randint(1, 100)
+            'bookId': random_book_id()
         }
-        self.client.delete("/removeFromWishlist", params=params)
+        self.client.delete("/removeFromWishlist", params=params, name="/removeFromWishlist")
 
     @task(1)
     def update_user(self):
@@ -106,29 +126,33 @@ class UserBehavior(TaskSet):
     @task(1)
     def purchase(self):
         # Simulate making a purchase
+        quantity = random.randint(1, 5)
+        unit_price = round(random.uniform(10.0, 100.0), 2)
+        total_price = round(quantity * unit_price, 2)
         purchase_data = {
             'customer_name': 'Test User',
             'address': '123 Test Lane',
             'date': datetime.now().strftime('%Y-%m-%d'),
             'purchasedDetails': {
                 'userId': self.user_id,
-                'bookId': random.randint(1, 100),
+                'bookId': random_book_id(),
                 'price': round(random.uniform(10.0, 100.0), 2),
                 'paymentMethod': 'Credit Card'
             },
             'purchases': [
                 {
                     'book_code': f"BOOK{random.randint(100, 999)}",
-                    'quantity': random.randint(1, 5),
-                    'unit_price': round(random.uniform(10.0, 100.0), 2),
-                    'total_price': round(random.uniform(10.0, 500.0), 2)
+                    'quantity': quantity,
+                    'unit_price': unit_price,
+                    'total_price': total_price
                 }
             ],
             'method': {
                 'type': 'Credit Card',
                 'account_name': 'Test User',
                 'account_number': '1234567890',
-                'pay_by': 'Online'
+                'pay_by': 'Online',
+                'tax': round(total_price * 0.10, 2)  # The invoice's "Our Fees (10%)" line
             }
         }
         self.client.post("/purchase", json=purchase_data)
@@ -137,7 +161,7 @@ class UserBehavior(TaskSet):
     def get_purchase_summary(self):
         # Get the user's purchase summary
         params = {'userId': self.user_id}
-        self.client.get("/user/purchases", params=params)
+        self.client.get("/user/purchases", params=params, name="/user/purchases")
 
     @task(1)
     def check_user(self):
@@ -156,5 +180,5 @@ class UserBehavior(TaskSet):
 
 class WebsiteUser(HttpUser):
     tasks = [UserBehavior]
-    wait_time = between(1, 5)  # Simulate user think time between 1 to 5 seconds
-    host = "https://backend-2-9t4g.onrender.com"  # Replace with your actual backend host and port
+    wait_time = between(*WAIT_TIME)  # Simulated think time, 1 to 5 seconds by default
+    host = LOAD_TEST_HOST  # Or pass --host
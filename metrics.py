@@ -0,0 +1,224 @@
+"""Request latency and database time, exported in Prometheus text format.
+
+Every request records its duration in a histogram labelled by endpoint
+(the URL rule, not the raw path), method and status. The database time
+and query count come from the cursors handed out by the connection pool
+(see wrap_cursor), and are recorded per endpoint as well.
+
+Each gunicorn worker counts in its own memory and writes a snapshot to
+METRICS_DIR at most every METRICS_FLUSH_INTERVAL seconds. /metrics sums
+the snapshots of every worker, live or exited, so counters never go
+backwards while the server runs. Clear the directory when the service is
+(re)deployed, the same way prometheus_client's multiprocess mode expects.
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+METRICS_DIR = os.getenv('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'unibooks-metrics'))
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', 1))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50)
+
+HISTOGRAMS = {
+    'http_request_duration_seconds': ('Request latency in seconds.', LATENCY_BUCKETS),
+    'db_time_per_request_seconds': ('Time spent in database calls per request, in seconds.', LATENCY_BUCKETS),
+    'db_queries_per_request': ('Queries issued per request.', QUERY_COUNT_BUCKETS),
+}
+
+
+class TimedCursor(object):
+    # Adds each call's time (and each statement) to every request being measured on this thread
+
+    def __init__(self, cursor, recorder):
+        self._cursor = cursor
+        self._recorder = recorder
+
+    def _timed(self, method, args, kwargs, statements):
+        start = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            self._recorder.add_db_time(time.perf_counter() - start, statements)
+
+    def execute(self, *args, **kwargs):
+        return self._timed(self._cursor.execute, args, kwargs, 1)
+
+    def executemany(self, *args, **kwargs):
+        return self._timed(self._cursor.executemany, args, kwargs, 1)
+
+    # Unbuffered (SSCursor) reads do their network I/O here
+    def fetchone(self):
+        return self._timed(self._cursor.fetchone, (), {}, 0)
+
+    def fetchmany(self, *args, **kwargs):
+        return self._timed(self._cursor.fetchmany, args, kwargs, 0)
+
+    def fetchall(self):
+        return self._timed(self._cursor.fetchall, (), {}, 0)
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class _Frame(object):
+    __slots__ = ('start', 'db_seconds', 'queries')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.db_seconds = 0.0
+        self.queries = 0
+
+
+class Metrics(object):
+
+    def __init__(self, directory=METRICS_DIR, flush_interval=METRICS_FLUSH_INTERVAL):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        # One file per worker lifetime; a recycled pid must not overwrite an exited worker's totals
+        self._path = os.path.join(self.directory, f"{self._pid}-{uuid.uuid4().hex}.json")
+        self._series = {name: {} for name in HISTOGRAMS}  # name -> {labels tuple: [bucket counts..., sum, count]}
+        self._dirty = False
+        self._flusher = None
+
+    def _frames(self):
+        frames = getattr(self._local, 'frames', None)
+        if frames is None:
+            frames = self._local.frames = []
+        return frames
+
+    def wrap_cursor(self, cursor):
+        return TimedCursor(cursor, self)
+
+    def add_db_time(self, seconds, statements):
+        # Nested requests (/batch entries) count towards their parent too
+        for frame in self._frames():
+            frame.db_seconds += seconds
+            frame.queries += statements
+
+    def begin(self):
+        self._frames().append(_Frame())
+
+    def end(self, endpoint, method, status):
+        frames = self._frames()
+        if not frames:
+            return
+        frame = frames.pop()
+        elapsed = time.perf_counter() - frame.start
+        labels = (('endpoint', endpoint), ('method', method), ('status', str(status)))
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            self._observe('http_request_duration_seconds', labels, elapsed)
+            self._observe('db_time_per_request_seconds', labels[:2], frame.db_seconds)
+            self._observe('db_queries_per_request', labels[:2], frame.queries)
+            self._dirty = True
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._run, name='metrics-flusher', daemon=True)
+                self._flusher.start()
+
+    def _run(self):
+        # Started lazily, so each gunicorn worker gets its own after the fork
+        while True:
+            time.sleep(self.flush_interval)
+            if self._dirty:
+                try:
+                    self.flush()
+                except OSError as e:
+                    print(f"Error writing metrics: {e}")
+
+    def _observe(self, name, labels, value):
+        buckets = HISTOGRAMS[name][1]
+        series = self._series[name].get(labels)
+        if series is None:
+            series = self._series[name][labels] = [0] * (len(buckets) + 2)
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                series[i] += 1  # Stored non-cumulative; summed up when rendered
+                break
+        series[-2] += value
+        series[-1] += 1
+
+    def flush(self):
+        """Write this worker's totals where /metrics (in any worker) can read them."""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            data = {name: [[list(map(list, labels)), values] for labels, values in series.items()]
+                    for name, series in self._series.items()}
+            self._dirty = False
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, self._path)
+
+    def collect(self):
+        """Totals summed over every worker's snapshot."""
+        totals = {name: {} for name in HISTOGRAMS}
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            names = []
+        for filename in names:
+            if not filename.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, filename)) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue  # Unreadable snapshot; skip it this scrape
+            for name, series in data.items():
+                if name not in totals:
+                    continue
+                for labels, values in series:
+                    key = tuple(map(tuple, labels))
+                    current = totals[name].get(key)
+                    if current is None:
+                        totals[name][key] = list(values)
+                    else:
+                        totals[name][key] = [a + b for a, b in zip(current, values)]
+        return totals
+
+    def render(self):
+        """Prometheus text exposition of collect()."""
+        self.flush()
+        lines = []
+        for name, series in self.collect().items():
+            help_text, buckets = HISTOGRAMS[name]
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            for labels, values in sorted(series.items()):
+                cumulative = 0
+                for bound, count in zip(buckets, values):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', _number(bound)),))} {cumulative}")
+                lines.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {values[-1]}")
+                lines.append(f"{name}_sum{_labels(labels)} {_number(values[-2])}")
+                lines.append(f"{name}_count{_labels(labels)} {values[-1]}")
+        return '\n'.join(lines) + '\n'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _labels(labels):
+    escaped = (
+        (key, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for key, value in labels
+    )
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
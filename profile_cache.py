@@ -0,0 +1,108 @@
+"""Read-through LRU + TTL cache of user profiles.
+
+Profiles are cached once per user and can be found by userId or by email.
+Lookups fold case the way MySQL's default collation compares. The write
+endpoints invalidate entries here and publish the invalidation to the
+other workers through the cache bus.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from collation import fold
+
+PROFILE_CACHE_SIZE = int(os.getenv('PROFILE_CACHE_SIZE', 10000))
+PROFILE_CACHE_TTL = int(os.getenv('PROFILE_CACHE_TTL', 300))
+
+PROFILE_FIELDS = ('userId', 'email', 'username', 'level', 'profileUrl', 'address', 'phone', 'department',
+                  'flatno', 'street', 'city', 'state', 'postalcode', 'haswelcomed')
+PROFILE_QUERY = "SELECT " + ', '.join(PROFILE_FIELDS) + " FROM users WHERE {} = %s"
+
+
+class ProfileCache(object):
+
+    def __init__(self, size=PROFILE_CACHE_SIZE, ttl=PROFILE_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._by_id = OrderedDict()  # Folded userId -> (profile, expires_at), least recently used first
+        self._ids_by_email = {}  # Folded email -> folded userId
+        self._lock = threading.Lock()
+
+    def get(self, connect, user_id=None, email=None):
+        """Profile dict for the user with this userId (or email), or None if there is none."""
+        profile = self._lookup(user_id, email)
+        if profile is not None:
+            self.hits += 1
+            return profile
+
+        self.misses += 1
+        cursor = connect().cursor()
+        try:
+            if user_id:
+                cursor.execute(PROFILE_QUERY.format('userId'), (user_id,))
+            else:
+                cursor.execute(PROFILE_QUERY.format('email'), (email,))
+            row = cursor.fetchone()
+        finally:
+            cursor.close()
+
+        if row is None:
+            return None
+        profile = dict(zip(PROFILE_FIELDS, row))
+        self._store(profile)
+        return profile
+
+    def _lookup(self, user_id, email):
+        with self._lock:
+            key = fold(user_id) if user_id else self._ids_by_email.get(fold(email))
+            entry = self._by_id.get(key)
+            if entry is None:
+                return None
+            profile, expires_at = entry
+            if expires_at < time.monotonic():
+                self._drop(key)
+                return None
+            self._by_id.move_to_end(key)
+            return profile
+
+    def _store(self, profile):
+        key = fold(profile['userId'])
+        with self._lock:
+            self._drop(key)
+            self._by_id[key] = (profile, time.monotonic() + self.ttl)
+            if profile['email']:
+                self._ids_by_email[fold(profile['email'])] = key
+            while len(self._by_id) > self.size:
+                self._drop(next(iter(self._by_id)))
+
+    def _drop(self, key):
+        entry = self._by_id.pop(key, None)
+        if entry is not None:
+            email = fold(entry[0]['email'])
+            if self._ids_by_email.get(email) == key:
+                del self._ids_by_email[email]
+
+    def invalidate(self, user_id=None, email=None):
+        with self._lock:
+            if user_id:
+                self._drop(fold(user_id))
+            if email:
+                key = self._ids_by_email.get(fold(email))
+                if key is not None:
+                    self._drop(key)
+
+    def invalidate_key(self, key):
+        # Cache bus keys are 'id:<userId>' or 'email:<email>'
+        kind, _, value = key.partition(':')
+        if kind == 'id':
+            self.invalidate(user_id=value)
+        elif kind == 'email':
+            self.invalidate(email=value)
+
+    def clear(self):
+        with self._lock:
+            self._by_id.clear()
+            self._ids_by_email.clear()
@@ -0,0 +1,118 @@
+"""Per-user purchase totals, kept up to date by /purchase.
+
+/user/purchases reads one row from here instead of summing every purchase
+the user has made. record() runs inside the purchase transaction, so the
+totals commit (or roll back) with the purchase rows. rebuild() recomputes
+the table from `purchases` and reports any drift; run it once to backfill
+an existing database:
+
+    flask rebuild-purchase-totals [--check]
+
+CREATE TABLE user_purchase_totals (
+    userId VARCHAR(255) COLLATE utf8mb3_general_ci NOT NULL PRIMARY KEY,  -- Matches userId column in users table
+    totalSum DECIMAL(14, 2) NOT NULL DEFAULT 0,     -- SUM(purchases.price)
+    totalBooks INT NOT NULL DEFAULT 0,              -- COUNT(purchases.bookId)
+    FOREIGN KEY (userId) REFERENCES users(userId)
+);
+"""
+from decimal import Decimal, ROUND_HALF_UP
+
+CENT = Decimal('0.01')
+
+RECORD_QUERY = """
+    INSERT INTO user_purchase_totals (userId, totalSum, totalBooks) VALUES (%s, %s, %s)
+    ON DUPLICATE KEY UPDATE totalSum = totalSum + VALUES(totalSum), totalBooks = totalBooks + VALUES(totalBooks)
+"""
+TOTALS_QUERY = "SELECT totalSum, totalBooks FROM user_purchase_totals WHERE userId = %s"
+RECOMPUTE_QUERY = "SELECT userId, SUM(price), COUNT(bookId) FROM purchases GROUP BY userId"
+STORED_QUERY = "SELECT userId, totalSum, totalBooks FROM user_purchase_totals"
+LOCK_USER_QUERY = "SELECT totalSum, totalBooks FROM user_purchase_totals WHERE userId = %s FOR UPDATE"
+RECOMPUTE_USER_QUERY = "SELECT SUM(price), COUNT(bookId) FROM purchases WHERE userId = %s LOCK IN SHARE MODE"
+REPLACE_QUERY = """
+    INSERT INTO user_purchase_totals (userId, totalSum, totalBooks) VALUES (%s, %s, %s)
+    ON DUPLICATE KEY UPDATE totalSum = VALUES(totalSum), totalBooks = VALUES(totalBooks)
+"""
+
+
+def _money(price):
+    # Rounded as MySQL stores it in the DECIMAL(10, 2) purchases.price column:
+    # half away from zero, not Decimal's default half-to-even
+    return Decimal(str(price)).quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+def record(cursor, rows):
+    """Add purchase rows (userId, bookId, price, ...) to their users' totals.
+
+    Call on the purchase transaction's cursor before inserting the rows
+    themselves: taking the totals row lock first is what rebuild() relies
+    on to re-check a user without deadlocking against a purchase.
+    """
+    totals = {}
+    for row in rows:
+        user_id, book_id, price = row[0], row[1], row[2]
+        total_sum, total_books = totals.get(user_id, (Decimal(0), 0))
+        totals[user_id] = (total_sum + _money(price), total_books + (book_id is not None))
+    # Sorted, so concurrent purchases lock the totals rows in the same order
+    cursor.executemany(RECORD_QUERY, [(user_id,) + totals[user_id] for user_id in sorted(totals)])
+
+
+def lookup(connection, user_id):
+    """(totalSum, totalBooks) for the user; zeros if they have bought nothing."""
+    cursor = connection.cursor()
+    try:
+        cursor.execute(TOTALS_QUERY, (user_id,))
+        row = cursor.fetchone()
+    finally:
+        cursor.close()
+    if row is None:
+        return Decimal(0), 0
+    return row[0], row[1]
+
+
+def rebuild(connection, check_only=False):
+    """Recompute every user's totals from `purchases`.
+
+    Returns a list of (userId, stored, recomputed) for users whose stored
+    totals were wrong; with check_only the table is left as it was.
+    """
+    cursor = connection.cursor()
+    try:
+        cursor.execute(RECOMPUTE_QUERY)
+        actual = {user_id: (_money(total_sum or 0), total_books) for user_id, total_sum, total_books in cursor.fetchall()}
+        cursor.execute(STORED_QUERY)
+        stored = {user_id: (_money(total_sum), total_books) for user_id, total_sum, total_books in cursor.fetchall()}
+        connection.rollback()  # End the read view; the fixes below need current rows
+
+        drift = []
+        for user_id in sorted(set(actual) | set(stored)):
+            expected = actual.get(user_id, (Decimal(0), 0))
+            found = stored.get(user_id)
+            if found == expected or (found is None and expected == (Decimal(0), 0)):
+                continue
+            if not check_only:
+                found, expected = _repair(connection, cursor, user_id)
+                if found == expected:
+                    continue  # Only looked wrong because a purchase landed between the two reads
+            drift.append((user_id, found, expected))
+        return drift
+    finally:
+        cursor.close()
+
+
+def _repair(connection, cursor, user_id):
+    # Holding the totals row lock keeps new purchases for this user out
+    # (record() takes it first), so the locking SUM below is exact
+    try:
+        cursor.execute(LOCK_USER_QUERY, (user_id,))
+        row = cursor.fetchone()
+        found = (_money(row[0]), row[1]) if row else None
+        cursor.execute(RECOMPUTE_USER_QUERY, (user_id,))
+        total_sum, total_books = cursor.fetchone()
+        expected = (_money(total_sum or 0), total_books or 0)
+        if found != expected:
+            cursor.execute(REPLACE_QUERY, (user_id,) + expected)
+        connection.commit()
+        return found, expected
+    except Exception:
+        connection.rollback()
+        raise
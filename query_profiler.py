@@ -0,0 +1,211 @@
+"""Opt-in query profiler (QUERY_PROFILE=True).
+
+Every statement run through a pooled cursor is recorded with its
+fingerprint (the SQL with literals, placeholders and IN/VALUES lists
+collapsed), duration, row count and the route that ran it.
+
+- Statements slower than QUERY_PROFILE_SLOW_MS are printed to the log.
+  A sample of them (QUERY_PROFILE_EXPLAIN_RATE, and always the first
+  time a fingerprint is slow) also gets an EXPLAIN, run when the request
+  ends so it never interleaves with an open result set.
+- A request that runs one fingerprint QUERY_PROFILE_REPEAT_THRESHOLD
+  times or more is flagged as a likely N+1.
+
+Each response carries an X-Query-Profile header summarising its queries,
+and the worker's totals, slow log and flagged requests can be dumped as
+JSON. Profiling is per worker and meant for staging or a short session
+in production, not to be left on.
+"""
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter, deque
+
+QUERY_PROFILE = os.getenv('QUERY_PROFILE') == 'True'
+QUERY_PROFILE_SLOW_MS = float(os.getenv('QUERY_PROFILE_SLOW_MS', 100))
+QUERY_PROFILE_EXPLAIN_RATE = float(os.getenv('QUERY_PROFILE_EXPLAIN_RATE', 0.1))
+QUERY_PROFILE_REPEAT_THRESHOLD = int(os.getenv('QUERY_PROFILE_REPEAT_THRESHOLD', 5))
+QUERY_PROFILE_LOG_SIZE = int(os.getenv('QUERY_PROFILE_LOG_SIZE', 100))  # Slow queries / flagged requests kept for the dump
+
+_STRING = re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.|\"\")*\"")
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_ROWS = re.compile(r'\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+')
+_SPACE = re.compile(r'\s+')
+
+
+def fingerprint(sql):
+    """Normalised form of a statement, equal for statements that differ only in values."""
+    if isinstance(sql, bytes):
+        sql = sql.decode('utf-8', 'replace')
+    sql = sql.replace('%s', '?')
+    sql = _STRING.sub('?', sql)
+    sql = _NUMBER.sub('?', sql)
+    sql = _LIST.sub('(...)', sql)
+    sql = _ROWS.sub('(...)', sql)
+    return _SPACE.sub(' ', sql).strip()
+
+
+class ProfiledCursor(object):
+
+    def __init__(self, cursor, profiler):
+        self._cursor = cursor
+        self._profiler = profiler
+
+    def _run(self, method, query, args):
+        start = time.perf_counter()
+        try:
+            return method(query, args)
+        finally:
+            rowcount = getattr(self._cursor, 'rowcount', -1)
+            self._profiler.record(self._cursor, query, args, time.perf_counter() - start, rowcount)
+
+    def execute(self, query, args=None):
+        return self._run(self._cursor.execute, query, args)
+
+    def executemany(self, query, args):
+        return self._run(self._cursor.executemany, query, args)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class _Request(object):
+
+    def __init__(self, route):
+        self.route = route
+        self.queries = 0
+        self.seconds = 0.0
+        self.slow = 0
+        self.fingerprints = Counter()
+        self.explains = []  # (entry, connection, query, args) to EXPLAIN when the request ends
+
+
+class QueryProfiler(object):
+
+    def __init__(self, slow_ms=QUERY_PROFILE_SLOW_MS, explain_rate=QUERY_PROFILE_EXPLAIN_RATE,
+                 repeat_threshold=QUERY_PROFILE_REPEAT_THRESHOLD, log_size=QUERY_PROFILE_LOG_SIZE):
+        self.slow_seconds = slow_ms / 1000
+        self.explain_rate = explain_rate
+        self.repeat_threshold = repeat_threshold
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._stats = {}  # fingerprint -> {'count', 'seconds', 'max_seconds', 'rows', 'routes'}
+        self._explained = set()
+        self.slow_log = deque(maxlen=log_size)
+        self.repeated = deque(maxlen=log_size)
+
+    def wrap_cursor(self, cursor):
+        return ProfiledCursor(cursor, self)
+
+    def _requests(self):
+        requests = getattr(self._local, 'requests', None)
+        if requests is None:
+            requests = self._local.requests = []
+        return requests
+
+    def begin(self, route):
+        self._requests().append(_Request(route))
+
+    def record(self, cursor, query, args, seconds, rowcount):
+        requests = self._requests()
+        current = requests[-1] if requests else None
+        route = current.route if current is not None else '(outside a request)'
+        slow = seconds >= self.slow_seconds
+        key = fingerprint(query)
+
+        for request in requests:  # /batch entries count towards the batch as well
+            request.queries += 1
+            request.seconds += seconds
+        if current is not None:
+            current.fingerprints[key] += 1
+
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'rows': 0, 'routes': Counter()}
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            stats['rows'] += max(rowcount, 0)
+            stats['routes'][route] += 1
+
+            if not slow:
+                return
+            entry = {'fingerprint': key, 'ms': round(seconds * 1000, 3), 'rows': rowcount, 'route': route,
+                     'at': time.time(), 'explain': None}
+            self.slow_log.append(entry)
+            explain = key not in self._explained or random.random() < self.explain_rate
+            if explain:
+                self._explained.add(key)
+
+        print(f"Slow query ({entry['ms']} ms, {rowcount} rows) on {route}: {key}")
+        if current is not None:
+            current.slow += 1
+            if explain:
+                # Kept now: closing the cursor drops its reference to the connection
+                current.explains.append((entry, cursor.connection, query, args))
+
+    def report(self):
+        """X-Query-Profile header value for the current request, or None."""
+        requests = self._requests()
+        if not requests:
+            return None
+        current = requests[-1]
+        repeated = [f"{count}x {key[:80]}" for key, count in current.fingerprints.most_common()
+                    if count >= self.repeat_threshold]
+        report = f"queries={current.queries}; db_ms={current.seconds * 1000:.1f}; slow={current.slow}"
+        if repeated:
+            report += '; repeated=' + ' | '.join(repeated)
+        return report
+
+    def end(self):
+        requests = self._requests()
+        if not requests:
+            return
+        current = requests.pop()
+
+        for entry, connection, query, args in current.explains:
+            entry['explain'] = self._explain(connection, query, args)
+            print(f"EXPLAIN {entry['fingerprint']}: {entry['explain']}")
+
+        repeated = {key: count for key, count in current.fingerprints.items() if count >= self.repeat_threshold}
+        if repeated:
+            with self._lock:
+                self.repeated.append({'route': current.route, 'at': time.time(), 'queries': current.queries,
+                                      'fingerprints': repeated})
+            for key, count in repeated.items():
+                print(f"Repeated query on {current.route}: {count}x {key}")
+
+    def _explain(self, connection, query, args):
+        # On a fresh cursor of the same connection; the request's own result sets are done by now
+        try:
+            explain_cursor = connection.cursor()
+            try:
+                explain_cursor.execute('EXPLAIN ' + query, args)
+                columns = [column[0] for column in explain_cursor.description]
+                return [dict(zip(columns, row)) for row in explain_cursor.fetchall()]
+            finally:
+                explain_cursor.close()
+        except Exception as e:
+            return f"EXPLAIN failed: {e}"
+
+    def dump(self):
+        """Worker totals by fingerprint (slowest total first), slow log and flagged requests."""
+        with self._lock:
+            queries = [
+                {'fingerprint': key, 'count': stats['count'], 'total_ms': round(stats['seconds'] * 1000, 3),
+                 'mean_ms': round(stats['seconds'] * 1000 / stats['count'], 3),
+                 'max_ms': round(stats['max_seconds'] * 1000, 3), 'rows': stats['rows'],
+                 'routes': dict(stats['routes'])}
+                for key, stats in self._stats.items()
+            ]
+            slow = list(self.slow_log)
+            repeated = list(self.repeated)
+        queries.sort(key=lambda query: query['total_ms'], reverse=True)
+        return {'pid': os.getpid(), 'queries': queries, 'slow': slow, 'repeated': repeated}
@@ -0,0 +1,150 @@
+"""Per-user wishlist sets, kept in sync with the `wishlists` table.
+
+Each user's wishlist is loaded once (book ids only) and answered from
+memory after that: "already in the wishlist?" is a set lookup, and the
+book rows come from the catalog snapshot instead of a books JOIN
+wishlists scan. Writes go to the database first and then update the set;
+other workers drop their copy through the cache bus. Entries expire
+after WISHLIST_CACHE_TTL seconds as a backstop for writes made outside
+the app.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from collation import fold
+
+WISHLIST_CACHE_SIZE = int(os.getenv('WISHLIST_CACHE_SIZE', 10000))
+WISHLIST_CACHE_TTL = int(os.getenv('WISHLIST_CACHE_TTL', 300))
+WISHLIST_BATCH_MAX = int(os.getenv('WISHLIST_BATCH_MAX', 100))  # Book ids per batch request
+
+# Columns the wishlist endpoints have always returned, in order
+WISHLIST_FIELDS = ('id', 'code', 'title', 'department', 'price', 'available', 'level', 'rating', 'category')
+
+LOAD_QUERY = "SELECT bookId FROM wishlists WHERE userId = %s"
+# No unique key on (userId, bookId) to lean on, so add() checks for itself: the
+# locking read holds the index range, so a concurrent add of the same book waits
+EXISTING_QUERY = "SELECT bookId FROM wishlists WHERE userId = %s AND bookId IN ({}) FOR UPDATE"
+INSERT_QUERY = "INSERT INTO wishlists (userId, bookId) VALUES (%s, %s)"
+DELETE_QUERY = "DELETE FROM wishlists WHERE userId = %s AND bookId IN ({})"
+
+
+def book_ids(values):
+    """Book ids from a request (a list) as ints; ValueError for anything else."""
+    # A string is iterable too: "67" would otherwise mean books 6 and 7
+    if not isinstance(values, list):
+        raise ValueError('Book ids must be a list')
+    if any(isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()) for value in values):
+        raise ValueError('Book ids must be integers')
+    try:
+        return [int(value) for value in values]
+    except (TypeError, ValueError):
+        raise ValueError('Book ids must be integers')
+
+
+class WishlistCache(object):
+
+    def __init__(self, size=WISHLIST_CACHE_SIZE, ttl=WISHLIST_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._users = OrderedDict()  # Folded userId -> (book ids as ordered dict keys, expires_at)
+        self._lock = threading.Lock()
+
+    def _books(self, connect, user_id):
+        key = fold(user_id)
+        with self._lock:
+            entry = self._users.get(key)
+            if entry is not None and entry[1] >= time.monotonic():
+                self._users.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+        self.misses += 1
+        cursor = connect().cursor()
+        try:
+            cursor.execute(LOAD_QUERY, (user_id,))
+            books = OrderedDict((row[0], None) for row in cursor.fetchall())
+        finally:
+            cursor.close()
+
+        with self._lock:
+            self._users[key] = (books, time.monotonic() + self.ttl)
+            self._users.move_to_end(key)
+            while len(self._users) > self.size:
+                self._users.popitem(last=False)
+        return books
+
+    def get(self, connect, user_id):
+        """The user's wishlisted book ids, oldest first."""
+        return list(self._books(connect, user_id))
+
+    def add(self, connect, user_id, ids):
+        """Add books to the wishlist; returns the ids that weren't already in it."""
+        books = self._books(connect, user_id)
+        candidates = [book_id for book_id in OrderedDict.fromkeys(ids) if book_id not in books]
+        if not candidates:
+            return []
+
+        connection = connect()
+        cursor = connection.cursor()
+        try:
+            # Rows the set didn't know about (written elsewhere) aren't added twice
+            cursor.execute(EXISTING_QUERY.format(', '.join(['%s'] * len(candidates))), (user_id,) + tuple(candidates))
+            existing = set(row[0] for row in cursor.fetchall())
+            added = [book_id for book_id in candidates if book_id not in existing]
+            if added:
+                # executemany() sends the rows as a single multi-row INSERT
+                cursor.executemany(INSERT_QUERY, [(user_id, book_id) for book_id in added])
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            self.invalidate(user_id)
+            raise
+        finally:
+            cursor.close()
+
+        with self._lock:
+            for book_id in candidates:  # Rows that were there already (set out of date) belong in it too
+                books[book_id] = None
+        return added
+
+    def remove(self, connect, user_id, ids):
+        """Remove books from the wishlist; returns the ids that were in it."""
+        books = self._books(connect, user_id)
+        ids = list(OrderedDict.fromkeys(ids))
+        if not ids:
+            return []
+        removed = [book_id for book_id in ids if book_id in books]
+
+        # Deletes every requested id, so a row the set doesn't know about still goes
+        connection = connect()
+        cursor = connection.cursor()
+        try:
+            cursor.execute(DELETE_QUERY.format(', '.join(['%s'] * len(ids))), (user_id,) + tuple(ids))
+            deleted = cursor.rowcount
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            self.invalidate(user_id)
+            raise
+        finally:
+            cursor.close()
+
+        if deleted != len(removed):
+            self.invalidate(user_id)  # The set was out of date; reload it next time
+            return removed
+        with self._lock:
+            for book_id in removed:
+                books.pop(book_id, None)
+        return removed
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._users.pop(fold(user_id), None)
+
+    def clear(self):
+        with self._lock:
+            self._users.clear()